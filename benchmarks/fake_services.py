@@ -0,0 +1,155 @@
+"""Local stand-ins for GigaChat, Fusionbrain, Ozon and the photo CDN, served by one aiohttp app.
+
+Responses are canned but shaped like the real APIs, so the real clients run unchanged against
+them. `latency` adds a fixed delay to every API call to model the network and the providers.
+"""
+import asyncio
+import hashlib
+import itertools
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+from benchmarks.fixtures import icon_images, product_photos
+from src.client_library.ozon.OzonClient import OzonClient
+from src.engine.image_fetcher import image_fetcher
+from src.engine.infographics_engine import gigachat, text2image
+
+BULLET_POINTS = ['Быстрый нагрев воды', 'Подогрев сиденья', 'Простая установка']
+PRODUCT_NAME = 'Электронная крышка-биде для унитаза'
+
+
+class FakeServices:
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.photos = product_photos()
+        self.photo_etags = {name: hashlib.md5(data).hexdigest() for name, data in self.photos.items()}
+        self.icons = icon_images()
+        self._next_icon = itertools.cycle(range(len(self.icons)))
+        self._generations = {}
+        self.calls = {}
+        self._runner = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def photo_url(self, name):
+        return f'{self.url}/photos/{name}.jpg'
+
+    async def _api_call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # GigaChat
+
+    async def gigachat_oauth(self, request):
+        await self._api_call('gigachat_oauth')
+        return web.json_response({'access_token': uuid.uuid4().hex,
+                                  'expires_at': int((time.time() + 1800) * 1000)})
+
+    async def gigachat_completions(self, request):
+        await self._api_call('gigachat_completions')
+        payload = await request.json()
+        prompt = payload['messages'][-1]['content']
+        # A per-request marker in the description becomes a bullet point, so every render is unique
+        marker = re.search(r'Артикул (\S+)', prompt)
+        bullet_points = BULLET_POINTS[:2] + [f'Артикул {marker.group(1)}' if marker else BULLET_POINTS[2]]
+        content = '\n'.join(f'{i}. {text}' for i, text in enumerate(bullet_points, 1)) + '\nКонец'
+        return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+
+    # Fusionbrain
+
+    async def fusionbrain_models(self, request):
+        await self._api_call('fusionbrain_models')
+        return web.json_response([{'id': 4, 'name': 'Kandinsky', 'version': 3.0, 'type': 'TEXT2IMAGE'}])
+
+    async def fusionbrain_run(self, request):
+        await self._api_call('fusionbrain_run')
+        await request.post()
+        request_id = str(uuid.uuid4())
+        self._generations[request_id] = self.icons[next(self._next_icon)]
+        return web.json_response({'uuid': request_id, 'status': 'INITIAL'})
+
+    async def fusionbrain_status(self, request):
+        await self._api_call('fusionbrain_status')
+        request_id = request.match_info['request_id']
+        image = self._generations.pop(request_id, None)
+        if image is None:
+            return web.json_response({'uuid': request_id, 'status': 'FAIL', 'errorDescription': 'unknown uuid'})
+        return web.json_response({'uuid': request_id, 'status': 'DONE', 'images': [image], 'censored': False})
+
+    # Ozon
+
+    async def ozon_product_info(self, request):
+        await self._api_call('ozon_product_info')
+        body = await request.json()
+        offer_id = str(body.get('offer_id', ''))
+        size = offer_id.split('-')[0] if offer_id.split('-')[0] in self.photos else 'medium'
+        return web.json_response({'result': {'offer_id': offer_id, 'name': PRODUCT_NAME,
+                                             'images': [self.photo_url(size)]}})
+
+    async def ozon_product_description(self, request):
+        await self._api_call('ozon_product_description')
+        body = await request.json()
+        return web.json_response({'result': {'offer_id': body.get('offer_id'), 'name': PRODUCT_NAME,
+                                             'description': f'{PRODUCT_NAME}. Артикул {body.get("offer_id")}'}})
+
+    async def ozon_product_list(self, request):
+        await self._api_call('ozon_product_list')
+        return web.json_response({'result': {'items': [{'product_id': 1, 'offer_id': 'medium-1'}],
+                                             'total': 1, 'last_id': ''}})
+
+    # Photo CDN
+
+    async def photo(self, request):
+        name = request.match_info['name']
+        if name not in self.photos:
+            raise web.HTTPNotFound()
+        self.calls['photo'] = self.calls.get('photo', 0) + 1
+        etag = f'"{self.photo_etags[name]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=self.photos[name], content_type='image/jpeg', headers={'ETag': etag})
+
+    def create_app(self):
+        app = web.Application(client_max_size=32 * 2 ** 20)
+        app.router.add_post('/gigachat/oauth', self.gigachat_oauth)
+        app.router.add_post('/gigachat/api/v1/chat/completions', self.gigachat_completions)
+        app.router.add_get('/fusionbrain/key/api/v1/models', self.fusionbrain_models)
+        app.router.add_post('/fusionbrain/key/api/v1/text2image/run', self.fusionbrain_run)
+        app.router.add_get('/fusionbrain/key/api/v1/text2image/status/{request_id}', self.fusionbrain_status)
+        app.router.add_post('/ozon/v2/product/info', self.ozon_product_info)
+        app.router.add_post('/ozon/v1/product/info/description', self.ozon_product_description)
+        app.router.add_post('/ozon/v2/product/list', self.ozon_product_list)
+        app.router.add_get('/photos/{name}.jpg', self.photo)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def point_clients_here(self):
+        """Send the bot's GigaChat, Fusionbrain and Ozon clients to this server instead of the real APIs."""
+        gigachat.auth_url = f'{self.url}/gigachat/oauth'
+        gigachat.api_url = f'{self.url}/gigachat/api/v1/'
+        gigachat.invalidate_token()
+        text2image.base_url = f'{self.url}/fusionbrain/'
+        text2image.model_id = None
+        OzonClient.BASE_URL = f'{self.url}/ozon'
+        # The stand-ins answer as fast as the machine allows, Ozon's per-seller limit would only add sleeps
+        OzonClient.REQUESTS_PER_SECOND = 10 ** 6
+        image_fetcher.max_connections = max(image_fetcher.max_connections, 100)
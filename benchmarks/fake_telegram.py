@@ -0,0 +1,69 @@
+"""A Bot API session that answers locally, for driving the real Dispatcher without Telegram."""
+import asyncio
+import itertools
+import json
+import time
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import InputFile
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+
+
+class FakeTelegramSession(BaseSession):
+    """Answers every Bot API call itself after `latency` seconds.
+
+    Files being sent are read in full, as a real upload would. Sent messages come back as
+    Message objects through the usual response validation; every other method returns True.
+    Each call is counted by method name in `calls`, and every text or caption sent in `texts`.
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}
+        self.texts = {}
+        self.uploaded_bytes = 0
+        self._message_ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout=None):
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        text = getattr(method, 'text', None) or getattr(method, 'caption', None)
+        if text:
+            self.texts[text] = self.texts.get(text, 0) + 1
+
+        for field in method.model_fields:
+            value = getattr(method, field)
+            if isinstance(value, InputFile):
+                async for chunk in value.read(bot):
+                    self.uploaded_bytes += len(chunk)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = True
+        if name.startswith('send') or name == 'editMessageText':
+            result = self._message(method)
+        response = self.check_response(bot, method, 200, json.dumps({'ok': True, 'result': result}))
+        return response.result
+
+    def _message(self, method):
+        chat_id = getattr(method, 'chat_id', None) or 0
+        message = {
+            'message_id': getattr(method, 'message_id', None) or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        text = getattr(method, 'text', None) or getattr(method, 'caption', None)
+        if text:
+            message['text'] = text
+        return message
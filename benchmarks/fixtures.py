@@ -0,0 +1,87 @@
+"""Synthetic inputs for the benchmarks: product photos of several sizes, icons and a model stand-in.
+
+Everything is generated with a fixed seed, so runs on different machines render the same pictures.
+"""
+import base64
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+# name -> (width, height); the sizes Ozon sellers upload, from a small thumbnail to a camera original
+PHOTO_SIZES = {
+    'small': (640, 640),
+    'medium': (1600, 1600),
+    'large': (4000, 3000),
+}
+ICON_SIZE = (768, 768)
+ICON_COLORS = [(231, 76, 60), (46, 204, 113), (52, 152, 219), (241, 196, 15), (155, 89, 182)]
+
+
+def product_photo(size, seed=0):
+    """A JPEG of a lit, rounded product on a light, slightly noisy studio background."""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    background = 235 + rng.integers(-6, 6, size=(height, width, 1), dtype=np.int16)
+    gradient = np.linspace(0, 20, height, dtype=np.int16)[:, None, None]
+    pixels = np.clip(background - gradient, 0, 255).astype(np.uint8).repeat(3, axis=2)
+    img = Image.fromarray(pixels, mode='RGB')
+
+    draw = ImageDraw.Draw(img)
+    box = (width * 0.25, height * 0.15, width * 0.75, height * 0.9)
+    draw.rounded_rectangle(box, radius=min(width, height) // 12, fill=(70, 90, 120))
+    highlight = (width * 0.32, height * 0.22, width * 0.45, height * 0.8)
+    draw.rounded_rectangle(highlight, radius=min(width, height) // 30, fill=(120, 145, 180))
+    img = img.filter(ImageFilter.GaussianBlur(radius=max(1, min(width, height) // 400)))
+
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def product_photos():
+    return {name: product_photo(size, seed=i) for i, (name, size) in enumerate(PHOTO_SIZES.items())}
+
+
+def icon_images():
+    """Base64 PNG icons like Fusionbrain returns: a colored glyph on a white square."""
+    icons = []
+    for color in ICON_COLORS:
+        img = Image.new('RGB', ICON_SIZE, (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((160, 160, 608, 608), fill=color)
+        draw.rectangle((330, 250, 438, 518), fill=(255, 255, 255))
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        icons.append(base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return icons
+
+
+class _ModelInput:
+    name = 'input.image'
+    shape = ['batch', 3, 320, 320]
+
+
+class _FakeInferenceSession:
+    def __init__(self):
+        yy, xx = np.mgrid[0:320, 0:320]
+        ellipse = ((xx - 160) / 90) ** 2 + ((yy - 165) / 130) ** 2
+        self.mask = np.clip(1.5 - ellipse, 0, 1).astype(np.float32)
+
+    def get_inputs(self):
+        return [_ModelInput()]
+
+    def run(self, output_names, feed):
+        batch = next(iter(feed.values()))
+        return [np.broadcast_to(self.mask, (batch.shape[0], 1, 320, 320)).copy()]
+
+
+class FakeRembgSession:
+    """Stand-in for a rembg U2netSession that returns a fixed elliptical mask without running a model.
+
+    For measuring everything around background removal on machines without the model weights;
+    cutout timings taken with it say nothing about rembg itself.
+    """
+
+    def __init__(self):
+        self.inner_session = _FakeInferenceSession()
@@ -0,0 +1,299 @@
+"""End-to-end load test of one bot process.
+
+Synthetic sellers walk through the bot the way real ones do - /start, add an Ozon token, pick a
+product, then create infographics or improve the description - by feeding Update objects
+through the real Dispatcher, middlewares and routers. Bot API calls are answered by
+FakeTelegramSession and GigaChat, Fusionbrain and Ozon by the local stand-ins, so nothing leaves
+the machine. Each seller sends the next message only after the bot has answered the previous one.
+
+For every number of simultaneous sellers the test reports update throughput, the latency
+distribution of each handler and the event loop lag. The capacity is the largest number of
+sellers for which every handler stays within its p95 target, the loop lag stays within
+`--max-loop-lag` and nothing fails or is turned away by a full render queue. With a fixed
+`--seed` the same configuration replays the same conversations.
+
+    python -m benchmarks.load_test --sellers 10,50,100,200 --fake-model
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import configobj
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from benchmarks.fake_services import FakeServices
+from benchmarks.fake_telegram import FakeTelegramSession
+from benchmarks.fixtures import PHOTO_SIZES
+from benchmarks.render_benchmark import PeakRssSampler, describe, git_commit, prepare_engine
+from src.client_library.ozon.OzonClient import OzonClient
+from src.engine.image_fetcher import image_fetcher
+from src.engine.infographics_engine import gigachat, text2image
+from src.handlers.common import common_router
+from src.handlers.covers import covers_router, render_queue, RENDER_QUEUE_FULL_MESSAGE
+from src.of_logging import logging_middleware
+from src.utils.metrics import metrics_middleware
+from src.utils.shared_state import shared_state, GLOBAL_CONFIG_PATH
+
+RESULTS_PATH = 'benchmarks/results/'
+RENDER_HANDLER = 'create_infographics'
+# Handlers catch their own exceptions and tell the seller to try again
+FAILURE_PREFIX = 'Не получилось'
+
+
+class HandlerTimer:
+    """Inner middleware recording how long each handler took, by handler function name."""
+
+    def __init__(self):
+        self.samples = {}
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+
+class LoopLagMonitor:
+    """How late the event loop wakes up a task that sleeps for `interval`, sampled continuously."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+
+
+def conversation(seller_id, rng, actions, render_share):
+    """The messages one seller sends, in order."""
+    size = rng.choice(list(PHOTO_SIZES))
+    messages = ['/start', 'Добавить токен Озон', f'{seller_id}:benchmark-key',
+                'Выбрать продукт на Озон', f'{size}-{seller_id}']
+    for _ in range(actions):
+        messages.append('Создать инфографику' if rng.random() < render_share else 'Улучшить описание товара')
+    return messages
+
+
+def make_update(update_id, seller_id, text):
+    user = {'id': seller_id, 'is_bot': False, 'first_name': 'Seller', 'username': f'seller{seller_id}'}
+    return Update.model_validate({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': seller_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+        },
+    })
+
+
+def failed_answers(session):
+    return sum(count for text, count in session.texts.items() if text.startswith(FAILURE_PREFIX))
+
+
+async def run_level(dp, bot, sellers, first_seller_id, options):
+    session = bot.session
+    rng = random.Random(f'{options.seed}:{sellers}')
+    conversations = [conversation(first_seller_id + i, rng, options.actions, options.render_share)
+                     for i in range(sellers)]
+    think_times = [[rng.uniform(0, 2 * options.think_time) for _ in messages] for messages in conversations]
+
+    timer = HandlerTimer()
+    dp.message.middleware(timer)
+    errors = []
+    update_ids = iter(range(first_seller_id * 100, 10 ** 12))
+    calls_before = dict(session.calls)
+    rejected_before = session.texts.get(RENDER_QUEUE_FULL_MESSAGE, 0)
+    failures_before = failed_answers(session)
+
+    async def seller(seller_id, messages, pauses):
+        # Sellers start spread over the first second rather than all in the same instant
+        await asyncio.sleep(rng.random())
+        for text, pause in zip(messages, pauses):
+            try:
+                await dp.feed_update(bot, make_update(next(update_ids), seller_id, text))
+            except Exception as e:
+                errors.append(f'{text}: {e!r}')
+            if pause:
+                await asyncio.sleep(pause)
+
+    with LoopLagMonitor() as lag, PeakRssSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*[seller(first_seller_id + i, messages, pauses)
+                               for i, (messages, pauses) in enumerate(zip(conversations, think_times))])
+        wall = time.perf_counter() - start
+    dp.message.middleware.unregister(timer)
+
+    updates = sum(len(messages) for messages in conversations)
+    handlers = {name: describe(samples) for name, samples in sorted(timer.samples.items())}
+    calls = {name: count - calls_before.get(name, 0) for name, count in session.calls.items()
+             if count - calls_before.get(name, 0)}
+    rejected = session.texts.get(RENDER_QUEUE_FULL_MESSAGE, 0) - rejected_before
+    renders = len(timer.samples.get(RENDER_HANDLER, [])) - rejected
+    failures = failed_answers(session) - failures_before
+
+    within_slo = (
+        not errors and not failures and not rejected
+        and all(stats['p95'] <= (options.render_slo if name == RENDER_HANDLER else options.slo)
+                for name, stats in handlers.items())
+        and (describe(lag.samples)['p95'] or 0) <= options.max_loop_lag
+    )
+    return {
+        'sellers': sellers,
+        'updates': updates,
+        'wall_seconds': wall,
+        'updates_per_sec': updates / wall,
+        'infographics': renders,
+        'infographics_per_min': renders / wall * 60,
+        'rejected_renders': rejected,
+        'failed_answers': failures,
+        'errors': errors[:10],
+        'error_count': len(errors),
+        'handlers': handlers,
+        'loop_lag': describe(lag.samples),
+        'bot_api_calls': calls,
+        'peak_rss_mb': rss.peak_bytes / 2 ** 20,
+        'within_slo': within_slo,
+    }
+
+
+def print_level(result):
+    lag = result['loop_lag']
+    print(f"\n{result['sellers']} sellers: {result['updates']} updates in {result['wall_seconds']:.1f}s, "
+          f"{result['updates_per_sec']:.1f} updates/sec, {result['infographics_per_min']:.1f} infographics/min, "
+          f"loop lag p95 {lag['p95'] * 1000:.1f} ms max {lag['max'] * 1000:.1f} ms, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB" + ('' if result['within_slo'] else '  OVER TARGET'))
+    for name, stats in result['handlers'].items():
+        print(f"  {name:<36} p50 {stats['p50'] * 1000:9.1f} ms   p95 {stats['p95'] * 1000:9.1f} ms"
+              f"   n={stats['count']}")
+    if result['rejected_renders']:
+        print(f"  {result['rejected_renders']} renders turned away, the render queue was full")
+    if result['failed_answers']:
+        print(f"  {result['failed_answers']} answers told the seller something went wrong")
+    if result['error_count']:
+        print(f"  {result['error_count']} errors, e.g. {result['errors'][0]}")
+
+
+async def main(options):
+    global_config = configobj.ConfigObj(GLOBAL_CONFIG_PATH)
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+
+    # Users, usage and FSM data go to a scratch backend, never to the bot's own databases
+    shared_state.configure(backend=options.state, redis_url=options.redis_url,
+                           user_db_path=os.path.join(work_dir, 'users.sqlite3'), usage_db_path_base=work_dir,
+                           config_path=GLOBAL_CONFIG_PATH)
+
+    services = await FakeServices(latency=options.api_latency).start()
+    services.point_clients_here()
+    await prepare_engine(global_config, work_dir, int(global_config['render_workers']),
+                         render_queue.executor, options.fake_model)
+
+    session = FakeTelegramSession(latency=options.telegram_latency)
+    bot = Bot(token='1:benchmark', session=session)
+    dp = Dispatcher(storage=shared_state.create_fsm_storage())
+    dp.update.outer_middleware(logging_middleware)
+    dp.update.outer_middleware(metrics_middleware)
+    dp.include_router(common_router)
+    dp.include_router(covers_router)
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: global_config[key] for key in ('render_workers', 'render_queue_size', 'rembg_model',
+                                                       'cutout_batch_window_ms', 'cutout_max_batch',
+                                                       'infographic_format', 'infographic_quality')},
+        'options': vars(options),
+        'levels': [],
+    }
+
+    try:
+        next_seller_id = 1
+        for sellers in [int(level) for level in options.sellers.split(',')]:
+            result = await run_level(dp, bot, sellers, next_seller_id, options)
+            next_seller_id += sellers
+            results['levels'].append(result)
+            print_level(result)
+    finally:
+        await services.stop()
+        await text2image.close()
+        await gigachat.close()
+        await image_fetcher.close()
+        await OzonClient.close_all()
+        await shared_state.close()
+        render_queue.shutdown()
+
+    capacity = max([level['sellers'] for level in results['levels'] if level['within_slo']], default=0)
+    at_capacity = next((level for level in results['levels'] if level['sellers'] == capacity), None)
+    results['capacity_sellers'] = capacity
+    if at_capacity:
+        print(f"\nCapacity: {capacity} simultaneous sellers, {at_capacity['updates_per_sec']:.1f} updates/sec, "
+              f"{at_capacity['infographics_per_min']:.1f} infographics/min")
+    else:
+        print('\nCapacity: no level stayed within the targets')
+
+    output = options.output or os.path.join(
+        RESULTS_PATH, f"load_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['git_commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'Results written to {output}')
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the bot with synthetic sellers')
+    parser.add_argument('--sellers', default='10,50,100', help='comma-separated numbers of simultaneous sellers')
+    parser.add_argument('--actions', type=int, default=3,
+                        help='infographics or description requests per seller after choosing a product')
+    parser.add_argument('--render-share', type=float, default=0.5,
+                        help='share of those requests that create an infographic')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean pause between messages, seconds')
+    parser.add_argument('--seed', default='0', help='seed for the conversations and pauses')
+    parser.add_argument('--slo', type=float, default=1.0, help='p95 target for handlers other than rendering')
+    parser.add_argument('--render-slo', type=float, default=60.0, help=f'p95 target for {RENDER_HANDLER}')
+    parser.add_argument('--max-loop-lag', type=float, default=0.1, help='p95 target for the event loop lag')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='seconds per Bot API call')
+    parser.add_argument('--api-latency', type=float, default=0.2,
+                        help='seconds added to every GigaChat, Fusionbrain and Ozon call')
+    parser.add_argument('--state', default='fake', choices=['sqlite', 'redis', 'fake'],
+                        help='state backend, with scratch databases for sqlite')
+    parser.add_argument('--redis-url', help='scratch Redis for --state redis, never the bot\'s own redis_url')
+    parser.add_argument('--fake-model', action='store_true',
+                        help='replace rembg with a fixed mask, for machines without the model weights')
+    parser.add_argument('--output', help=f'result file (default: a timestamped file in {RESULTS_PATH})')
+    options = parser.parse_args()
+
+    if options.state == 'redis':
+        # The test writes users, usage and FSM data, it must not run against the bot's Redis
+        if not options.redis_url:
+            parser.error('--state redis needs --redis-url pointing at a scratch Redis')
+        bot_redis_url = configobj.ConfigObj(GLOBAL_CONFIG_PATH)['redis_url']
+        if options.redis_url.rstrip('/') == bot_redis_url.rstrip('/'):
+            parser.error(f'--redis-url {options.redis_url} is the bot\'s own redis_url, use a scratch database')
+    return options
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
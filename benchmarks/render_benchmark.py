@@ -0,0 +1,365 @@
+"""Offline rendering benchmark.
+
+Renders infographics end to end - Ozon product card, photo download, GigaChat bullet points,
+Fusionbrain icons, background removal, layout and encoding - against the local stand-ins in
+fake_services.py, at several concurrency levels. Reports images/sec, p50/p95 of every stage,
+peak RSS, Python allocations and icon library hits per level, and writes everything to a JSON file.
+By default every icon is generated, as for a new bullet point; `--icons fresh` starts each level with
+an empty icon library and `--icons library` keeps one library for the whole run. With
+`--compare` the run is checked against an earlier result file and exits with 1 on a regression.
+
+    python -m benchmarks.render_benchmark --concurrency 1,4,8 --requests 24
+    python -m benchmarks.render_benchmark --fake-model --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import configobj
+
+from benchmarks.fake_services import FakeServices
+from benchmarks.fixtures import PHOTO_SIZES, FakeRembgSession
+from src.adapters.OzonAdapter import OzonAdapter
+from src.client_library.ozon.OzonClient import OzonClient
+from src.engine.cutout import cutout_batcher
+from src.engine.image_fetcher import image_fetcher
+from src.engine.infographics_engine import get_infographic_for_product, gigachat, text2image, resolve_quality
+from src.engine.render_queue import RenderQueue
+from src.engine.rembg_sessions import rembg_sessions, default_intra_op_threads
+from src.engine.result_cache import infographic_cache
+from src.engine.icon_library import icon_library
+from src.engine.templates import background_templates
+from src.utils.metrics import render_stage_seconds
+
+RESULTS_PATH = 'benchmarks/results/'
+BENCHMARK_OZON_TOKEN = 'benchmark:benchmark'
+# Above any similarity, so the icon library only stores icons and never returns one
+ICONS_NEVER_REUSED = 2.0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def describe(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'max': max(values) if values else None,
+    }
+
+
+class StageRecorder:
+    """Collects every render_stage_seconds observation, the histogram itself keeps only buckets."""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._observe = render_stage_seconds.observe
+
+    def __enter__(self):
+        def observe(value, **labels):
+            with self._lock:
+                self.samples.setdefault(labels['stage'], []).append(value)
+            self._observe(value, **labels)
+        render_stage_seconds.observe = observe
+        return self
+
+    def __exit__(self, *exc_info):
+        del render_stage_seconds.observe
+
+
+class PeakRssSampler:
+    """Peak resident set size while the block runs, sampled from /proc every few milliseconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # Not Linux: the peak of the whole process so far, in KiB (bytes on macOS)
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_bytes = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.current_rss())
+
+
+async def prepare_engine(global_config, work_dir, render_workers, executor, fake_model=False):
+    """Apply the global.ini engine settings with the caches in `work_dir`, then load the model and templates."""
+    infographic_cache.configure(path=os.path.join(work_dir, 'infographics'), max_bytes=2 ** 30)
+    icon_library.configure(path=os.path.join(work_dir, 'icons'),
+                           threshold=float(global_config['icon_match_threshold']), max_bytes=2 ** 30)
+    image_fetcher.configure(cache_path=os.path.join(work_dir, 'images'), cache_max_bytes=2 ** 30,
+                            max_bytes=int(global_config['image_max_mb']) * 2 ** 20,
+                            max_pixels=int(global_config['image_max_pixels']))
+    cutout_batcher.configure(window=int(global_config['cutout_batch_window_ms']) / 1000,
+                             max_batch=int(global_config['cutout_max_batch']))
+    rembg_sessions.configure(model_name=global_config['rembg_model'],
+                             intra_op_threads=int(global_config['rembg_intra_op_threads'])
+                             or default_intra_op_threads(render_workers))
+
+    loop = asyncio.get_running_loop()
+    if fake_model:
+        rembg_sessions.register(rembg_sessions.model_name, FakeRembgSession())
+    else:
+        await loop.run_in_executor(executor, rembg_sessions.warm_up)
+    await loop.run_in_executor(executor, background_templates.preload)
+
+
+async def render_one(render_queue, request_id, size, output_format='png', quality=None):
+    """What create_infographics does for one user, minus Telegram."""
+    adapter = OzonAdapter(BENCHMARK_OZON_TOKEN)
+    with render_stage_seconds.time(stage='product_card'):
+        card = await adapter.load_product_card(f'{size}-{request_id}')
+    with render_stage_seconds.time(stage='download'):
+        product_image = await image_fetcher.fetch(card['images'][0])
+    return await render_queue.submit(get_infographic_for_product, product_image, card['name'],
+                                     card['description'], output_format=output_format, quality=quality)
+
+
+def configure_icons(global_config, work_dir, mode, level_name):
+    """Point the icon library at the directory and threshold `--icons` asks for."""
+    threshold = float(global_config['icon_match_threshold'])
+    if mode == 'generate':
+        icon_library.configure(path=os.path.join(work_dir, 'icons'), threshold=ICONS_NEVER_REUSED, max_bytes=2 ** 30)
+    elif mode == 'fresh':
+        icon_library.configure(path=os.path.join(work_dir, f'icons-{level_name}'), threshold=threshold,
+                               max_bytes=2 ** 30)
+
+
+async def run_level(render_queue, concurrency, requests, sizes, first_request_id, output_format='png',
+                    quality=None, trace_memory=True):
+    """`concurrency` users rendering `requests` infographics in total, photo sizes taken in turn."""
+    latencies = []
+    icon_hits, icon_misses = icon_library.hits, icon_library.misses
+    request_ids = iter(range(first_request_id, first_request_id + requests))
+    errors = []
+
+    async def user():
+        for request_id in request_ids:
+            size = sizes[request_id % len(sizes)]
+            start = time.perf_counter()
+            try:
+                await render_one(render_queue, request_id, size, output_format, quality)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    if trace_memory:
+        tracemalloc.start()
+    with StageRecorder() as recorder, PeakRssSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*[user() for _ in range(concurrency)])
+        wall = time.perf_counter() - start
+    traced_current, traced_peak = tracemalloc.get_traced_memory() if trace_memory else (None, None)
+    tracemalloc.stop()
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'completed': len(latencies),
+        'errors': errors[:10],
+        'error_count': len(errors),
+        'wall_seconds': wall,
+        'images_per_sec': len(latencies) / wall,
+        'latency': describe(latencies),
+        'stages': {stage: describe(samples) for stage, samples in sorted(recorder.samples.items())},
+        'peak_rss_mb': rss.peak_bytes / 2 ** 20,
+        'icon_library': {'hits': icon_library.hits - icon_hits, 'misses': icon_library.misses - icon_misses},
+        'traced_peak_mb': traced_peak / 2 ** 20 if traced_peak is not None else None,
+        'traced_retained_mb': traced_current / 2 ** 20 if traced_current is not None else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_level(result):
+    print(f"\nconcurrency {result['concurrency']}: {result['completed']}/{result['requests']} images in "
+          f"{result['wall_seconds']:.2f}s, {result['images_per_sec']:.2f} images/sec, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB"
+          + (f", traced peak {result['traced_peak_mb']:.1f} MB" if result['traced_peak_mb'] is not None else '')
+          + f", icon library {result['icon_library']['hits']} hits / {result['icon_library']['misses']} misses")
+    latency = result['latency']
+    if latency['count']:
+        print(f"  {'total':<18} p50 {latency['p50'] * 1000:8.1f} ms   p95 {latency['p95'] * 1000:8.1f} ms")
+    for stage, stats in result['stages'].items():
+        print(f"  {stage:<18} p50 {stats['p50'] * 1000:8.1f} ms   p95 {stats['p95'] * 1000:8.1f} ms"
+              f"   n={stats['count']}")
+    if result['error_count']:
+        print(f"  {result['error_count']} errors, e.g. {result['errors'][0]}")
+
+
+def compare(results, baseline, tolerance):
+    """Print the changes against `baseline` and return True if throughput dropped by more than `tolerance`."""
+    regressed = False
+    previous_levels = {level['concurrency']: level for level in baseline['levels']}
+    print(f"\nCompared with {baseline.get('git_commit')} from {baseline.get('created')}:")
+    for level in results['levels']:
+        previous = previous_levels.get(level['concurrency'])
+        if previous is None:
+            continue
+        change = level['images_per_sec'] / previous['images_per_sec'] - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressed = True
+        print(f"  concurrency {level['concurrency']}: {previous['images_per_sec']:.2f} -> "
+              f"{level['images_per_sec']:.2f} images/sec ({change:+.1%}){flag}")
+        for stage, stats in level['stages'].items():
+            previous_stats = previous['stages'].get(stage)
+            if previous_stats and previous_stats['p95'] and stats['p95'] > previous_stats['p95'] * (1 + tolerance):
+                print(f"    {stage} p95 {previous_stats['p95'] * 1000:.1f} -> {stats['p95'] * 1000:.1f} ms")
+    return regressed
+
+
+async def main(args):
+    global_config = configobj.ConfigObj('configs/global.ini')
+    render_workers = args.workers or int(global_config['render_workers'])
+    sizes = args.sizes.split(',')
+    for size in sizes:
+        if size not in PHOTO_SIZES:
+            raise SystemExit(f'Unknown photo size {size}, expected some of {",".join(PHOTO_SIZES)}')
+
+    services = await FakeServices(latency=args.api_latency).start()
+    services.point_clients_here()
+    render_queue = RenderQueue(render_workers, max_pending=10 ** 6)
+    work_dir = tempfile.mkdtemp(prefix='render_benchmark_')
+    await prepare_engine(global_config, work_dir, render_workers, render_queue.executor, args.fake_model)
+    configure_icons(global_config, work_dir, args.icons, 'warm-up')
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'render_workers': render_workers,
+        'rembg_model': 'fake' if args.fake_model else rembg_sessions.model_name,
+        'api_latency': args.api_latency,
+        'output_format': args.format,
+        'quality': resolve_quality(args.format, args.quality),
+        'photo_sizes': {size: PHOTO_SIZES[size] for size in sizes},
+        'icons': args.icons,
+        'levels': [],
+    }
+
+    try:
+        # One untimed render per photo size, so the first level does not pay for connection setup
+        await asyncio.gather(*[render_one(render_queue, -i - 1, size, args.format, args.quality)
+                               for i, size in enumerate(sizes)])
+
+        next_request_id = 0
+        for concurrency in [int(level) for level in args.concurrency.split(',')]:
+            requests = args.requests or max(2 * concurrency, len(sizes))
+            configure_icons(global_config, work_dir, args.icons, f'level-{concurrency}')
+            result = await run_level(render_queue, concurrency, requests, sizes, next_request_id,
+                                     args.format, args.quality, args.tracemalloc)
+            next_request_id += requests
+            results['levels'].append(result)
+            print_level(result)
+
+        if args.cached:
+            # The same requests again: product cards, photos and infographics all come from the caches
+            result = await run_level(render_queue, max(int(level) for level in args.concurrency.split(',')),
+                                     next_request_id, sizes, 0, args.format, args.quality, args.tracemalloc)
+            results['cached'] = result
+            print('\nRepeated requests (result cache hits):')
+            print_level(result)
+    finally:
+        await services.stop()
+        await text2image.close()
+        await gigachat.close()
+        await image_fetcher.close()
+        await OzonClient.close_all()
+        render_queue.shutdown()
+
+    results['api_calls'] = services.calls
+    output = args.output or os.path.join(
+        RESULTS_PATH, f"render_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['git_commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline infographic rendering benchmark')
+    parser.add_argument('--concurrency', default='1,4,8',
+                        help='comma-separated numbers of simultaneous users, one level each')
+    parser.add_argument('--requests', type=int, default=0,
+                        help='infographics per level (default: twice the concurrency)')
+    parser.add_argument('--sizes', default=','.join(PHOTO_SIZES), help='product photo sizes to cycle through')
+    parser.add_argument('--workers', type=int, default=0, help='render workers (default: render_workers)')
+    parser.add_argument('--format', default='png', choices=['png', 'webp', 'jpeg'])
+    parser.add_argument('--quality', type=int, help='encoder quality (default: the format\'s own default)')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds added to every GigaChat, Fusionbrain and Ozon call')
+    parser.add_argument('--fake-model', action='store_true',
+                        help='replace rembg with a fixed mask, for machines without the model weights')
+    parser.add_argument('--no-tracemalloc', dest='tracemalloc', action='store_false',
+                        help='skip allocation tracing, which slows Python code down noticeably')
+    parser.add_argument('--icons', default='generate', choices=['generate', 'fresh', 'library'],
+                        help='generate every icon (default), start each level with an empty icon library, '
+                             'or keep one library for the whole run')
+    parser.add_argument('--cached', action='store_true', help='also measure repeated requests served from cache')
+    parser.add_argument('--output', help=f'result file (default: a timestamped file in {RESULTS_PATH})')
+    parser.add_argument('--compare', help='earlier result file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='throughput drop, as a fraction, reported as a regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
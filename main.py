@@ -10,20 +10,23 @@ from pathlib import Path
 
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
 from aiogram.enums.parse_mode import ParseMode
 
-from aiogram.fsm.storage.redis import RedisStorage
-from aioredis.client import Redis
-
 from src.handlers.common import common_router
-from src.handlers.covers import covers_router
-from src.of_logging import logging_middleware
-
-
-from src.utils.json_utils import create_json_if_not_exist
-from src.utils.usage_limit import UsageLimiter
+from src.handlers.covers import covers_router, render_queue
+from src.engine.rembg_sessions import rembg_sessions, default_intra_op_threads
+from src.engine.cutout import cutout_batcher
+from src.engine.infographics_engine import text2image, gigachat, llm_responses
+from src.engine.templates import background_templates
+from src.engine.result_cache import infographic_cache
+from src.engine.icon_library import icon_library
+from src.engine.image_fetcher import image_fetcher
+from src.client_library.ozon.OzonClient import OzonClient
+from src.of_logging import logging_middleware, setup_logging
+from src.utils.shared_state import shared_state, GLOBAL_CONFIG_PATH
+from src.utils.metrics import metrics, metrics_middleware
+from src.webhook_server import WebhookServer
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -34,24 +37,59 @@ sys.path.append('/'.join(dirname(__file__).split('/')[:-2]))
 credentials = configobj.ConfigObj('configs/credentials/credentials.ini')
 global_config = configobj.ConfigObj('configs/global.ini')
 
-usage_limiter = UsageLimiter(config_path='configs/global.ini', db_path_base='db/')
-
 # Create logger
 logger = logging.getLogger('tg_main')
 logs_path = global_config['logs_path']
 Path(logs_path).mkdir(parents=True, exist_ok=True)
 logging.getLogger('googleapicliet.discovery_cache').setLevel(logging.ERROR)
-logging.basicConfig(format='%(asctime)s: %(message)s',
-                    datefmt='%d/%m/%Y %H:%M:%S',
-                    level=logging.INFO,
-                    handlers=[logging.FileHandler(logs_path + 'tg_bot.log',
-                                                  mode='a'),
-                              logging.StreamHandler()])
+# Handlers only enqueue records, a background thread writes them to the files in batches
+log_listener = setup_logging(logs_path,
+                             log_format=global_config['log_format'],
+                             sample_rate=float(global_config['chat_log_sample_rate']))
 
 bot = Bot(token=credentials['tg_bot']['TOKEN'],
           parse_mode=ParseMode.HTML)
 
 BOT_DB = global_config['bot_db_path']
+UPDATE_MODE = global_config['update_mode']
+SHUTDOWN_TIMEOUT = int(global_config['shutdown_timeout'])
+
+rembg_sessions.configure(
+    model_name=global_config['rembg_model'],
+    intra_op_threads=int(global_config['rembg_intra_op_threads'])
+    or default_intra_op_threads(int(global_config['render_workers']))
+)
+infographic_cache.configure(
+    path=global_config['infographic_cache_path'],
+    max_bytes=int(global_config['infographic_cache_max_mb']) * 2 ** 20
+)
+llm_responses.configure(
+    ttl=int(global_config['llm_cache_ttl']),
+    max_items=int(global_config['llm_cache_max_items'])
+)
+icon_library.configure(
+    path=global_config['icon_library_path'],
+    threshold=float(global_config['icon_match_threshold']),
+    max_bytes=int(global_config['icon_library_max_mb']) * 2 ** 20
+)
+image_fetcher.configure(
+    cache_path=global_config['image_cache_path'],
+    cache_max_bytes=int(global_config['image_cache_max_mb']) * 2 ** 20,
+    max_bytes=int(global_config['image_max_mb']) * 2 ** 20,
+    max_pixels=int(global_config['image_max_pixels'])
+)
+cutout_batcher.configure(
+    window=int(global_config['cutout_batch_window_ms']) / 1000,
+    max_batch=int(global_config['cutout_max_batch'])
+)
+shared_state.configure(
+    backend=global_config['state_backend'],
+    redis_url=global_config['redis_url'],
+    user_db_path=global_config['user_db_path'],
+    usage_db_path_base='db/',
+    config_path=GLOBAL_CONFIG_PATH,
+    fsm_ttl=int(global_config['fsm_ttl']) or None
+)
 
 
 async def set_commands(bot: Bot):
@@ -63,32 +101,71 @@ async def set_commands(bot: Bot):
     await bot.set_my_commands(commands)
 
 
+async def serve_webhook(dp: Dispatcher):
+    path = global_config['webhook_path']
+    secret_token = credentials['tg_bot'].get('WEBHOOK_SECRET') or None
+    server = WebhookServer(dp, bot, path=path, secret_token=secret_token, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+    webhook_url = global_config['webhook_url']
+    if webhook_url:
+        # Pending updates are kept: with several instances behind the same url one of them is always restarting
+        await bot.set_webhook(webhook_url.rstrip('/') + path, secret_token=secret_token,
+                              allowed_updates=dp.resolve_used_update_types())
+    await dp.emit_startup(bot=bot)
+    try:
+        await server.serve(global_config['webhook_host'], int(global_config['webhook_port']))
+    finally:
+        await dp.emit_shutdown(bot=bot)
+
+
 async def main(loop):
     logger.info("Starting bot")
 
-    # Создание json-файла, как db
-    json_fields = {
-        "users_nicknames_to_ids_map": {},
-        "ids_to_users_nicknames_map": {},
-        "user_info": {}
-    }
+    # Пользователи из старой json-базы (и из SQLite при переходе на redis) переносятся при первом запуске
+    await shared_state.migrate_users(BOT_DB)
+    shared_state.start()
 
-    create_json_if_not_exist(BOT_DB, json_fields)
+    logger.info("Warming up rembg sessions, background templates and the icon library")
+    await loop.run_in_executor(render_queue.executor, rembg_sessions.warm_up)
+    await loop.run_in_executor(render_queue.executor, background_templates.preload)
+    await loop.run_in_executor(render_queue.executor, icon_library.load)
 
-    # redis_client = Redis.from_url("redis://localhost:6379/5")
-    dp = Dispatcher(storage=MemoryStorage())
+    logger.info(f"Using {shared_state.backend} state backend")
+    dp = Dispatcher(storage=shared_state.create_fsm_storage())
     
     dp.update.outer_middleware(logging_middleware)
+    dp.update.outer_middleware(metrics_middleware)
 
     dp.include_router(common_router)
     dp.include_router(covers_router)
 
     await set_commands(bot)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await asyncio.gather(
-        asyncio.create_task(dp.start_polling(bot)),
-    )
+    metrics_port = int(global_config['metrics_port'])
+    metrics_runner = await metrics.serve(global_config['metrics_host'], metrics_port) if metrics_port else None
+    metrics_log_interval = int(global_config['metrics_log_interval'])
+    metrics_log_task = asyncio.ensure_future(metrics.log_summaries(metrics_log_interval)) if metrics_log_interval else None
+
+    try:
+        if UPDATE_MODE == 'webhook':
+            await serve_webhook(dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        # Infographics already being created are rendered and sent before the clients they use are closed
+        await render_queue.drain(SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+        if metrics_log_task is not None:
+            metrics_log_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await text2image.close()
+        await gigachat.close()
+        await image_fetcher.close()
+        await OzonClient.close_all()
+        await shared_state.close()
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,14 @@
 from src.client_library.client_exception import ClientException
 from .exceptions import ProductNotFound
 from src.client_library.ozon.OzonClient import OzonClient
+from src.utils.async_cache import AsyncTTLCache
+import asyncio
 import traceback
 
+# Product cards by (token, offer_id), so a seller re-entering the same SKU does not hit Ozon again
+PRODUCT_CARD_TTL = 300
+product_cards = AsyncTTLCache(ttl=PRODUCT_CARD_TTL, max_items=10000)
+
 class OzonAdapter:
     ozon_token: str
     client: OzonClient
@@ -15,7 +21,7 @@ class OzonAdapter:
     
     async def get_product_data(self, sku):
         try:
-            response = self.client.get_products_info({
+            response = await self.client.get_products_info({
                 'offer_id': sku,
             })
         except Exception as e:
@@ -24,16 +30,43 @@ class OzonAdapter:
 
     async def get_product_description(self, sku):
         try:
-            response = self.client.get_products_description({
+            response = await self.client.get_products_description({
                 'offer_id': sku,
             })
         except Exception as e:
             raise ProductNotFound()
         return response['result']
     
+    async def load_product_card(self, sku):
+        """Images, name and description of the product, loaded concurrently and cached for a few minutes.
+
+        Raises ProductNotFound if there is no such product. A product without a description gets
+        an empty name and description.
+        """
+        return await product_cards.get_or_load((self.ozon_token, sku), lambda: self._load_product_card(sku))
+
+    async def _load_product_card(self, sku):
+        product, description = await asyncio.gather(
+            self.get_product_data(sku),
+            self.get_product_description(sku),
+            return_exceptions=True
+        )
+        if isinstance(product, BaseException):
+            raise product
+        if isinstance(description, ProductNotFound):
+            description = None
+        elif isinstance(description, BaseException):
+            raise description
+
+        return {
+            'images': product['images'],
+            'name': description['name'] if description else '',
+            'description': description['description'] if description else '',
+        }
+
     async def test_token(self):
         try:
-            response = self.client.get_products({
+            response = await self.client.get_products({
                 "last_id": "",
                 "limit": 1
             })
@@ -42,9 +75,9 @@ class OzonAdapter:
         return True
     
     async def set_video_preview(self, sku, video_url):
-        product_data = self.client.get_product_attributes(sku)['result'][0]
-        product_attributes = self.client.get_product_attributes(sku)['result'][0]['attributes']
-        attributes = self.client.get_attributes(product_data['category_id'])['result'][0]['attributes']
+        product_data = (await self.client.get_product_attributes(sku))['result'][0]
+        product_attributes = product_data['attributes']
+        attributes = (await self.client.get_attributes(product_data['category_id']))['result'][0]['attributes']
 
         # print('product_attributes', product_attributes)
 
@@ -71,7 +104,7 @@ class OzonAdapter:
         }]
 
         try:
-            response = self.client.update_product_attributes(sku, product_attributes)
+            response = await self.client.update_product_attributes(sku, product_attributes)
             print('task_id', response)
         except ClientException as e:
             print(f"An unexpected error occurred: {e}")
@@ -0,0 +1,107 @@
+import asyncio
+import json
+
+import aiohttp
+
+from ..client_exception import ClientException
+
+
+class FusionBrainClient:
+    """Async Text2Image client for Fusionbrain (Kandinsky) with a shared connection pool."""
+    base_url: str
+    auth_headers: dict
+
+    def __init__(self, base_url, api_key, secret_key, max_connections=20):
+        self.base_url = base_url
+        self.auth_headers = {
+            'X-Key': f'Key {api_key}',
+            'X-Secret': f'Secret {secret_key}',
+        }
+        self.max_connections = max_connections
+        self.model_id = None
+        self._model_lock = asyncio.Lock()
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.auth_headers,
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, endpoint, **kwargs):
+        async with self._get_session().request(method, self.base_url + endpoint, **kwargs) as response:
+            if response.status >= 400:
+                text = await response.text()
+                raise ClientException(f'Fusionbrain error. Status code: {response.status}, '
+                                      f'Endpoint: {endpoint}, Response: {text}')
+            return await response.json(content_type=None)
+
+    async def get_model(self):
+        if self.model_id is None:
+            async with self._model_lock:
+                if self.model_id is None:
+                    data = await self.request('GET', 'key/api/v1/models')
+                    self.model_id = data[0]['id']
+        return self.model_id
+
+    async def generate(self, prompt, images=1, width=768, height=768):
+        params = {
+            "type": "GENERATE",
+            "numImages": images,
+            "width": width,
+            "height": height,
+            "generateParams": {
+                "query": f"{prompt}"
+            }
+        }
+
+        form = aiohttp.FormData()
+        form.add_field('model_id', str(await self.get_model()))
+        form.add_field('params', json.dumps(params), content_type='application/json')
+        data = await self.request('POST', 'key/api/v1/text2image/run', data=form)
+        return data['uuid']
+
+    async def check_generation(self, request_id):
+        return await self.request('GET', 'key/api/v1/text2image/status/' + request_id)
+
+    async def wait_for_generations(self, request_ids, timeout=300, delay=2, max_delay=10, backoff=1.5):
+        """Poll all pending generations together until every one is done.
+
+        The delay between polling rounds grows from `delay` to `max_delay`. Returns the
+        images of each generation in the order of `request_ids`.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        results = {}
+        pending = list(request_ids)
+
+        while True:
+            statuses = await asyncio.gather(*[self.check_generation(request_id) for request_id in pending])
+            for request_id, data in zip(pending, statuses):
+                if data['status'] == 'DONE':
+                    results[request_id] = data['images']
+                elif data['status'] == 'FAIL':
+                    raise ClientException(f'Fusionbrain generation {request_id} failed', data)
+
+            pending = [request_id for request_id in pending if request_id not in results]
+            if not pending:
+                return [results[request_id] for request_id in request_ids]
+
+            if loop.time() + delay > deadline:
+                raise asyncio.TimeoutError(f'Fusionbrain generations {pending} are not ready after {timeout}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * backoff, max_delay)
+
+    async def generate_images(self, prompts, timeout=300, **kwargs):
+        """Submit all prompts at once and return the first image (base64) for each of them."""
+        request_ids = await asyncio.gather(*[self.generate(prompt, **kwargs) for prompt in prompts])
+        images = await self.wait_for_generations(request_ids, timeout=timeout)
+        return [generated[0] for generated in images]
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import uuid
+
+import aiohttp
+
+from ..client_exception import ClientException
+
+
+class GigaChatClient:
+    """Async GigaChat client that caches the OAuth access token and keeps connections alive."""
+    auth_url: str
+    api_url: str
+    scope: str
+
+    # Refresh the token this many seconds before GigaChat says it expires
+    TOKEN_EXPIRY_MARGIN = 60
+
+    def __init__(self, auth_key, scope='GIGACHAT_API_PERS',
+                 auth_url='https://ngw.devices.sberbank.ru:9443/api/v2/oauth',
+                 api_url='https://gigachat.devices.sberbank.ru/api/v1/',
+                 max_connections=20):
+        self.auth_key = auth_key
+        self.scope = scope
+        self.auth_url = auth_url
+        self.api_url = api_url
+        self.max_connections = max_connections
+        self._access_token = None
+        self._expires_at = 0
+        self._token_lock = asyncio.Lock()
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # GigaChat certificates are issued by the Russian national CA, which is not in the default bundle
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ssl=False),
+                timeout=aiohttp.ClientTimeout(total=120)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_access_token(self):
+        if self._access_token and time.time() < self._expires_at:
+            return self._access_token
+
+        async with self._token_lock:
+            # Another coroutine may have refreshed the token while we were waiting for the lock
+            if self._access_token and time.time() < self._expires_at:
+                return self._access_token
+
+            headers = {
+                'Authorization': f'Bearer {self.auth_key}',
+                'RqUID': str(uuid.uuid4()),
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+            async with self._get_session().post(self.auth_url, headers=headers,
+                                                data={'scope': self.scope}) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise ClientException(f'GigaChat auth failed. Status code: {response.status}, Response: {text}')
+                data = await response.json(content_type=None)
+
+            self._access_token = data['access_token']
+            # expires_at is in milliseconds
+            self._expires_at = data['expires_at'] / 1000 - self.TOKEN_EXPIRY_MARGIN
+            return self._access_token
+
+    def invalidate_token(self):
+        self._access_token = None
+        self._expires_at = 0
+
+    async def complete(self, prompt, model='GigaChat:latest', temperature=0.7):
+        payload = {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            "temperature": temperature
+        }
+
+        for attempt in range(2):
+            headers = {'Authorization': f'Bearer {await self.get_access_token()}'}
+            async with self._get_session().post(self.api_url + 'chat/completions',
+                                                headers=headers, json=payload) as response:
+                if response.status == 401 and attempt == 0:
+                    # The token was revoked before its expiry time, get a new one and retry
+                    self.invalidate_token()
+                    continue
+                if response.status != 200:
+                    text = await response.text()
+                    raise ClientException(f'GigaChat completion failed. Status code: {response.status}, '
+                                          f'Response: {text}')
+                data = await response.json(content_type=None)
+                return data['choices'][0]['message']['content']
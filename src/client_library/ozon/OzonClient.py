@@ -1,30 +1,144 @@
-import requests
+import asyncio
+import json
+import random
+import time
 import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+import aiohttp
+
 from ..client_exception import ClientException
 
+
+class RateLimiter:
+    """Spaces requests of one Client-Id at least 1 / requests_per_second apart."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        # After a 429 nobody with this Client-Id should hit Ozon before Retry-After has passed
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
 class OzonClient:
     api_key: str
     client_id: str
     base_url: str
 
+    BASE_URL = "https://api-seller.ozon.ru"
+    MAX_RETRIES = 3
+    RETRY_BASE_DELAY = 0.5
+    REQUEST_TIMEOUT = 30
+    REQUESTS_PER_SECOND = 10
+    MAX_CONNECTIONS_PER_CLIENT = 10
+    MAX_SESSIONS = 256
+
+    # Connection pools and rate limiters are shared by all clients with the same Client-Id
+    _sessions = OrderedDict()
+    _rate_limiters = {}
+    # Requests running on each session; an evicted session is closed once its last request is done
+    _in_flight = {}
+
     def __init__(self, client_id, api_key):
         self.api_key = api_key
         self.client_id = client_id
-        self.base_url = "https://api-seller.ozon.ru"
-        
+        self.base_url = self.BASE_URL
+
+    def _get_session(self):
+        session = OzonClient._sessions.get(self.client_id)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS_PER_CLIENT),
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+            )
+            OzonClient._sessions[self.client_id] = session
+            while len(OzonClient._sessions) > self.MAX_SESSIONS:
+                stale_client_id, stale_session = OzonClient._sessions.popitem(last=False)
+                OzonClient._rate_limiters.pop(stale_client_id, None)
+                if not OzonClient._in_flight.get(stale_session):
+                    asyncio.ensure_future(stale_session.close())
+        OzonClient._sessions.move_to_end(self.client_id)
+        return session
+
+    @contextmanager
+    def _session_in_use(self):
+        session = self._get_session()
+        OzonClient._in_flight[session] = OzonClient._in_flight.get(session, 0) + 1
+        try:
+            yield session
+        finally:
+            remaining = OzonClient._in_flight.pop(session, 1) - 1
+            if remaining:
+                OzonClient._in_flight[session] = remaining
+            elif OzonClient._sessions.get(self.client_id) is not session and not session.closed:
+                asyncio.ensure_future(session.close())
+
+    def _get_rate_limiter(self):
+        limiter = OzonClient._rate_limiters.get(self.client_id)
+        if limiter is None:
+            limiter = OzonClient._rate_limiters[self.client_id] = RateLimiter(self.REQUESTS_PER_SECOND)
+        return limiter
 
-    def request(self, method: str, endpoint: str, body={}):
+    @classmethod
+    async def close_all(cls):
+        sessions = list(cls._sessions.values())
+        cls._sessions.clear()
+        cls._rate_limiters.clear()
+        cls._in_flight.clear()
+        for session in sessions:
+            await session.close()
+
+    async def request(self, method: str, endpoint: str, body={}, idempotent=False):
+        """Send a request, retrying 429 responses after Retry-After or a backoff.
+
+        Timeouts, connection errors and 5xx responses are retried only for `idempotent` requests:
+        Ozon may have applied a write that timed out, and sending it again could ship an order twice.
+        """
         url = self.base_url + endpoint
         headers = {'Client-Id': self.client_id, 'Api-Key': self.api_key}
-        response = requests.request(method, url, headers=headers, json=body)
-        return self.parse_request_response(response, endpoint, body)
-    
-    def parse_request_response(self, response, endpoint, body):
-        status_code = response.status_code
+        limiter = self._get_rate_limiter()
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            await limiter.wait()
+            retry_after = None
+            try:
+                with self._session_in_use() as session:
+                    async with session.request(method, url, headers=headers, json=body) as response:
+                        retryable = response.status == 429 or (idempotent and response.status >= 500)
+                        if retryable and attempt < self.MAX_RETRIES:
+                            retry_after = response.headers.get('Retry-After')
+                        else:
+                            content = await response.read()
+                            return await self.parse_request_response(response, content, endpoint, body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not idempotent or attempt == self.MAX_RETRIES:
+                    raise
+
+            # Exponential backoff with jitter, or what Ozon asked for in Retry-After
+            delay = self.RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+
+    async def parse_request_response(self, response, content, endpoint, body):
+        status_code = response.status
+        text = content.decode('utf-8', errors='replace')
         try:
-            data = response.json()
+            data = json.loads(text)
         except ValueError:
             data = []
 
@@ -32,55 +146,60 @@ class OzonClient:
             pass
         elif 400 <= status_code < 500:
             # Client Error
-            raise ClientException(f'Client error occurred. Status code: {status_code}, Endpoint: {endpoint}, Response: {response.text}, Data: {body}', data)
+            raise ClientException(f'Client error occurred. Status code: {status_code}, Endpoint: {endpoint}, Response: {text}, Data: {body}', data)
         elif 500 <= status_code < 600:
             # Server Error
-            raise ClientException(f'Server error occurred. Status code: {status_code}, Endpoint: {endpoint}, Response: {response.text}, Data: {body}', data)
+            raise ClientException(f'Server error occurred. Status code: {status_code}, Endpoint: {endpoint}, Response: {text}, Data: {body}', data)
         else:
-            raise ClientException(f'Unexpected status code: {status_code}, Endpoint: {endpoint}, Response: {response.text}, Data: {body}', data)
+            raise ClientException(f'Unexpected status code: {status_code}, Endpoint: {endpoint}, Response: {text}, Data: {body}', data)
 
         if "package-label" in endpoint:
             filename = "db/tmp/" + f'ozon_{str(uuid.uuid4())}.pdf'
-            with open(filename, 'wb') as f:
-                f.write(response.content)
+            await asyncio.to_thread(self.save_file, filename, content)
             return filename
         elif "get-barcode" in endpoint:
             filename = "db/tmp/" + f'ozon_{str(uuid.uuid4())}.png'
-            with open(filename, 'wb') as f:
-                f.write(response.content)
+            await asyncio.to_thread(self.save_file, filename, content)
             return filename
         else:
-            if response.text:
-                return response.json()
+            if text:
+                return data
             else:
                 return None
 
-    def get_products(self, body):
-        return self.request("POST", "/v2/product/list", body)
+    @staticmethod
+    def save_file(filename, content):
+        with open(filename, 'wb') as f:
+            f.write(content)
+
+    async def get_products(self, body):
+        return await self.request("POST", "/v2/product/list", body, idempotent=True)
     
-    def get_products_info(self, body):
-        return self.request("POST", "/v2/product/info", body)
+    async def get_products_info(self, body):
+        return await self.request("POST", "/v2/product/info", body, idempotent=True)
 
-    def get_products_description(self, body):
-        return self.request("POST", "/v1/product/info/description", body)
+    async def get_products_description(self, body):
+        return await self.request("POST", "/v1/product/info/description", body, idempotent=True)
 
-    def get_fbs_postings(self, body):
-        return self.request("POST", "/v3/posting/fbs/list", body)
+    async def get_fbs_postings(self, body):
+        return await self.request("POST", "/v3/posting/fbs/list", body, idempotent=True)
     
-    def get_fbo_postings(self, body):
-        return self.request("POST", "/v2/posting/fbo/list", body)
+    async def get_fbo_postings(self, body):
+        return await self.request("POST", "/v2/posting/fbo/list", body, idempotent=True)
     
-    def get_fbs_returns(self, body):
-        return self.request("POST", "/v3/returns/company/fbs", body)
+    async def get_fbs_returns(self, body):
+        return await self.request("POST", "/v3/returns/company/fbs", body, idempotent=True)
     
     # You can't pass more than 20 posting numbers at once
-    def get_lables(self, posting_numbers):
+    async def get_lables(self, posting_numbers):
         body = {
             "posting_number": posting_numbers
         }
-        return self.request("POST", "/v2/posting/fbs/package-label", body)
+        return await self.request("POST", "/v2/posting/fbs/package-label", body, idempotent=True)
     
-    def get_all_fbs_postings(self, days: int):
+    async def iter_fbs_postings(self, days: int):
+        """Yield FBS postings of the last `days` days page by page, fetching the next page while
+        the current one is being consumed."""
         to = datetime.now()
         since = to - timedelta(days=days)
         to_string = to.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
@@ -99,16 +218,26 @@ class OzonClient:
                 "analytics_data": True
             }
         }
-        all_fbs_postings = []
-        while True:
-            fbs_postings = self.get_fbs_postings(postings_body)
-            all_fbs_postings.extend(fbs_postings["result"]["postings"])
-            if not fbs_postings["result"]["has_next"]:
-                break
-            postings_body["offset"] += 1000
-        return all_fbs_postings
-    
-    def get_all_products(self, is_archived = False):
+        next_page = asyncio.ensure_future(self.get_fbs_postings(dict(postings_body)))
+        try:
+            while next_page is not None:
+                fbs_postings = await next_page
+                next_page = None
+                if fbs_postings["result"]["has_next"]:
+                    postings_body["offset"] += 1000
+                    next_page = asyncio.ensure_future(self.get_fbs_postings(dict(postings_body)))
+                for posting in fbs_postings["result"]["postings"]:
+                    yield posting
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def get_all_fbs_postings(self, days: int):
+        return [posting async for posting in self.iter_fbs_postings(days)]
+
+    async def iter_products(self, is_archived = False):
+        """Yield items of /v2/product/list page by page, fetching the next page while the current one
+        is being consumed."""
         products_body = {
             "last_id": "",
             "limit": 1000
@@ -117,47 +246,77 @@ class OzonClient:
         if is_archived:
             products_body["filter"] = {"visibility": "ARCHIVED"}
 
-        all_products = []
         total = 0
-        while True:
-            products = self.get_products(products_body)
-            all_products.extend(products["result"]["items"])
-            total += products_body["limit"]
-            if products["result"]["total"] <= total:
-                break
-            products_body["last_id"] = products["result"]["last_id"]
-        
-        all_offer_ids = [product["offer_id"] for product in all_products]
-        
+        next_page = asyncio.ensure_future(self.get_products(dict(products_body)))
+        try:
+            while next_page is not None:
+                products = await next_page
+                next_page = None
+                total += products_body["limit"]
+                if products["result"]["total"] > total:
+                    products_body["last_id"] = products["result"]["last_id"]
+                    next_page = asyncio.ensure_future(self.get_products(dict(products_body)))
+                for product in products["result"]["items"]:
+                    yield product
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def get_products_info_items(self, offer_ids):
+        body = {
+            "offer_id": offer_ids,
+            "product_id": [],
+            "sku": []
+        }
+        response = await self.get_products_info(body)
+        return response["result"]["items"]
+
+    async def iter_all_products(self, is_archived = False, concurrency = 4):
+        """Yield full product info for the whole catalog in list order.
+
+        Offer ids are sent to /v2/product/info in chunks of 1000 as the list is streamed,
+        with at most `concurrency` chunks in flight, so memory does not grow with the catalog.
+        """
         n = 1000 # max size
-        all_offer_ids_splitted = [all_offer_ids[i * n:(i + 1) * n] for i in range((len(all_offer_ids) + n - 1) // n )]
-
-        all_products = []
-        for offer_ids in all_offer_ids_splitted:
-            body = {
-                "offer_id": offer_ids,
-                "product_id": [],
-                "sku": []
-            }
-            response = self.get_products_info(body)
-            all_products.extend(response["result"]["items"])
+        pending = deque()
+        offer_ids = []
+        try:
+            async for product in self.iter_products(is_archived):
+                offer_ids.append(product["offer_id"])
+                if len(offer_ids) < n:
+                    continue
+                pending.append(asyncio.ensure_future(self.get_products_info_items(offer_ids)))
+                offer_ids = []
+                if len(pending) >= concurrency:
+                    for item in await pending.popleft():
+                        yield item
+
+            if offer_ids:
+                pending.append(asyncio.ensure_future(self.get_products_info_items(offer_ids)))
+            while pending:
+                for item in await pending.popleft():
+                    yield item
+        finally:
+            for task in pending:
+                task.cancel()
 
-        return all_products
+    async def get_all_products(self, is_archived = False):
+        return [product async for product in self.iter_all_products(is_archived)]
     
-    def ship_order(self, posting_number, packages):
+    async def ship_order(self, posting_number, packages):
         body = {
             'posting_number': posting_number,
             'packages': packages
         }
-        return self.request("POST", "/v3/posting/fbs/ship", body)
+        return await self.request("POST", "/v3/posting/fbs/ship", body)
 
-    def send_products(self, products):
+    async def send_products(self, products):
         body = {
             'items': products
         }
-        return self.request("POST", "/v2/product/import", body)
+        return await self.request("POST", "/v2/product/import", body)
 
-    def get_attribute_values(self, category_id, attribute_id):
+    async def get_attribute_values(self, category_id, attribute_id):
         body = {
             "attribute_id": attribute_id,
             "category_id": int(category_id),
@@ -165,9 +324,9 @@ class OzonClient:
             "last_value_id": 0,
             "limit": 5000
         }
-        return self.request("POST", "/v2/category/attribute/values", body)
+        return await self.request("POST", "/v2/category/attribute/values", body, idempotent=True)
         
-    def get_attributes(self, category_id):
+    async def get_attributes(self, category_id):
         body = {
             "attribute_type": "ALL",
             "category_id": [
@@ -175,30 +334,30 @@ class OzonClient:
             ],
             "language": "DEFAULT"
         }
-        return self.request("POST", "/v3/category/attribute", body)
+        return await self.request("POST", "/v3/category/attribute", body, idempotent=True)
 
-    def send_inventory(self, stocks):
+    async def send_inventory(self, stocks):
         body = {
             "stocks": stocks
         }
-        return self.request("POST", "/v2/products/stocks", body)
+        return await self.request("POST", "/v2/products/stocks", body)
 
-    def create_act(self, delivery_method_id: str, departure_date: str):
+    async def create_act(self, delivery_method_id: str, departure_date: str):
         body = {
             "delivery_method_id": delivery_method_id,
             "departure_date": departure_date
         }
 
-        return self.request("POST", "/v2/posting/fbs/act/create", body)
+        return await self.request("POST", "/v2/posting/fbs/act/create", body)
     
-    def get_barcode(self, id: str):
+    async def get_barcode(self, id: str):
         body = {
             "id": id
         }
 
-        return self.request("POST", "/v2/posting/fbs/act/get-barcode", body)
+        return await self.request("POST", "/v2/posting/fbs/act/get-barcode", body, idempotent=True)
     
-    def get_transactions(self, since: str, to: str):
+    async def get_transactions(self, since: str, to: str):
         body = {
             "date": {
                 "from": since,
@@ -207,30 +366,30 @@ class OzonClient:
             "transaction_type": "all"
         }
 
-        return self.request("POST", "/v3/finance/transaction/totals", body)
+        return await self.request("POST", "/v3/finance/transaction/totals", body, idempotent=True)
     
-    def archive_products(self, product_ids):
+    async def archive_products(self, product_ids):
         body = {
             "product_id": product_ids
         }
 
-        return self.request("POST", "/v1/product/archive", body)
+        return await self.request("POST", "/v1/product/archive", body)
     
-    def delete_products(self, offer_ids):
+    async def delete_products(self, offer_ids):
         body = {
             "products": [{"offer_id": str(id)} for id in offer_ids]
         }
 
-        return self.request("POST", "/v2/products/delete", body)
+        return await self.request("POST", "/v2/products/delete", body)
     
-    def send_price(self, prices):
+    async def send_price(self, prices):
         body = {
             "prices": prices
         }
 
-        return self.request("POST", "/v1/product/import/prices", body)
+        return await self.request("POST", "/v1/product/import/prices", body)
 
-    def update_product_attributes(self, offer_id, attributes):
+    async def update_product_attributes(self, offer_id, attributes):
         body = {
             'items': [
                 {
@@ -241,9 +400,9 @@ class OzonClient:
         }
         # print('body', body)
 
-        return self.request("POST", "/v1/product/attributes/update", body)
+        return await self.request("POST", "/v1/product/attributes/update", body)
     
-    def get_product_attributes(self, offer_id):
+    async def get_product_attributes(self, offer_id):
         body = {
             'filter': {
                 'offer_id': [offer_id],
@@ -251,4 +410,4 @@ class OzonClient:
             },
             'limit': 1
         }
-        return self.request("POST", "/v3/products/info/attributes", body)
\ No newline at end of file
+        return await self.request("POST", "/v3/products/info/attributes", body, idempotent=True)
\ No newline at end of file
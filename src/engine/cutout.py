@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+from src.engine.rembg_sessions import rembg_sessions
+
+# u2net family preprocessing, same constants as rembg's U2netSession; rembg_sessions refuses other models
+MODEL_INPUT_SIZE = (320, 320)
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def preprocess(images):
+    """Stack images into one normalized NCHW float32 batch."""
+    batch = np.stack([
+        np.asarray(img.convert('RGB').resize(MODEL_INPUT_SIZE, Image.LANCZOS), dtype=np.float32)
+        for img in images
+    ])
+    batch /= np.maximum(batch.max(axis=(1, 2, 3), keepdims=True), 1e-6)
+    batch = (batch - MEAN) / STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+def predict_masks(session, images):
+    """Return uint8 masks of MODEL_INPUT_SIZE, one per image, from a single inference call."""
+    inner_session = session.inner_session
+    model_input = inner_session.get_inputs()[0]
+    batch = preprocess(images)
+
+    if isinstance(model_input.shape[0], int) and model_input.shape[0] == 1:
+        # The model was exported with a fixed batch of 1, feed it one image at a time
+        pred = np.concatenate([
+            inner_session.run(None, {model_input.name: batch[i:i + 1]})[0]
+            for i in range(len(batch))
+        ])
+    else:
+        pred = inner_session.run(None, {model_input.name: batch})[0]
+
+    pred = pred[:, 0, :, :]
+    mi = pred.min(axis=(1, 2), keepdims=True)
+    ma = pred.max(axis=(1, 2), keepdims=True)
+    pred = (pred - mi) / np.maximum(ma - mi, 1e-6)
+    return (pred * 255).astype(np.uint8)
+
+
+def apply_mask_and_crop(img, mask):
+    """Cut `img` out with a model-sized mask and crop it to the visible area."""
+    mask = Image.fromarray(mask, mode='L').resize(img.size, Image.LANCZOS)
+
+    rgba = np.asarray(img.convert('RGBA'), dtype=np.uint16)
+    alpha = np.asarray(mask, dtype=np.uint16)[:, :, None]
+    cutout = ((rgba * alpha + 127) // 255).astype(np.uint8)
+
+    visible = cutout[:, :, 3] > 0
+    rows = np.flatnonzero(visible.any(axis=1))
+    cols = np.flatnonzero(visible.any(axis=0))
+    if len(rows) == 0:
+        return Image.fromarray(cutout, mode='RGBA')
+    return Image.fromarray(cutout[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], mode='RGBA')
+
+
+def mask_bbox(mask):
+    """The visible part of a model-sized mask as fractions (left, top, right, bottom) of the image."""
+    visible = mask > 0
+    rows = np.flatnonzero(visible.any(axis=1))
+    cols = np.flatnonzero(visible.any(axis=0))
+    if len(rows) == 0:
+        return 0.0, 0.0, 1.0, 1.0
+    height, width = mask.shape
+    return cols[0] / width, rows[0] / height, (cols[-1] + 1) / width, (rows[-1] + 1) / height
+
+
+class CutoutBatcher:
+    """Coalesces cutout requests from concurrent render workers into shared inference calls.
+
+    The first worker to arrive waits `window` seconds for others, then runs everything
+    that was queued in batches of up to `max_batch` images and hands out the results.
+    """
+    window: float
+    max_batch: int
+
+    def __init__(self, sessions, window=0.02, max_batch=16):
+        self.sessions = sessions
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = []
+        self._collecting = False
+
+    def configure(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+
+    def cutout(self, images):
+        """Cut every image out of its background and crop it to the visible area."""
+        return [apply_mask_and_crop(img, mask) for img, mask in zip(images, self.masks(images))]
+
+    def masks(self, images):
+        """Model-sized uint8 masks for the images, see predict_masks."""
+        if not images:
+            return []
+
+        future = Future()
+        with self._lock:
+            self._pending.append((list(images), future))
+            is_leader = not self._collecting
+            self._collecting = True
+
+        if is_leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._lock:
+                requests, self._pending = self._pending, []
+                self._collecting = False
+            self._run(requests)
+
+        return future.result()
+
+    def _run(self, requests):
+        try:
+            all_images = [img for images, _ in requests for img in images]
+            session = self.sessions.get()
+            results = []
+            for i in range(0, len(all_images), self.max_batch):
+                results.extend(predict_masks(session, all_images[i:i + self.max_batch]))
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for images, future in requests:
+            future.set_result(results[offset:offset + len(images)])
+            offset += len(images)
+
+
+cutout_batcher = CutoutBatcher(rembg_sessions)
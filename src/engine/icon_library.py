@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from io import BytesIO
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from src.engine.result_cache import atomic_write, evict_oldest
+
+logger = logging.getLogger('tg_main')
+
+# PNG text chunk holding the normalized bullet point an icon was generated for
+TEXT_CHUNK = 'bullet_point'
+NGRAM_SIZE = 3
+
+
+def normalize_text(text):
+    """Lowercase words without punctuation, the form icons are stored and matched under."""
+    text = text.lower().replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Character n-grams of each word, padded with spaces so short words and word edges count too."""
+    grams = set()
+    for word in text.split():
+        padded = f' {word} '
+        grams.update(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+    return grams
+
+
+class IconLibrary:
+    """Background-removed icons on disk, reused for bullet points that read alike.
+
+    Every icon is a PNG named by a hash of its normalized bullet point, which is also stored
+    in the file itself. Lookups go through an in-memory inverted index of character trigrams:
+    the stored text with the highest Dice similarity to the bullet point wins if it reaches
+    `threshold`, so "Простая установка" finds the icon made for "простая установка!" or
+    "Простую установку".
+
+    Hits refresh the file's mtime; when the directory grows past `max_bytes`, the icons
+    with the oldest mtime are removed from disk and from the index. A `threshold` above 1
+    turns reuse off, every icon is then generated and only stored. `hits` and `misses`
+    count the lookups.
+    """
+    path: str
+    threshold: float
+    max_bytes: int
+
+    def __init__(self, path, threshold=0.7, max_bytes=100 * 2 ** 20):
+        self.path = path
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._texts = {}
+        self._ngrams = {}
+        self._index = {}
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, path, threshold, max_bytes):
+        with self._lock:
+            self.path = path
+            self.threshold = threshold
+            self.max_bytes = max_bytes
+            self._texts = {}
+            self._ngrams = {}
+            self._index = {}
+            self._loaded = False
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+    def _file_path(self, key):
+        return os.path.join(self.path, f'{key}.png')
+
+    def _add_to_index(self, key, text):
+        grams = char_ngrams(text)
+        self._texts[key] = text
+        self._ngrams[key] = len(grams)
+        for gram in grams:
+            self._index.setdefault(gram, set()).add(key)
+
+    def _remove_from_index(self, key):
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        del self._ngrams[key]
+        for gram in char_ngrams(text):
+            keys = self._index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[gram]
+
+    def load(self):
+        """Index the icons already on disk. Only the PNG headers are read, the pixels load on a hit."""
+        with self._lock:
+            if self._loaded:
+                return
+            if os.path.isdir(self.path):
+                for entry in os.scandir(self.path):
+                    if not entry.name.endswith('.png') or entry.name.startswith('.'):
+                        continue
+                    try:
+                        with Image.open(entry.path) as img:
+                            text = img.text.get(TEXT_CHUNK)
+                    except OSError:
+                        logger.warning(f'Skipping unreadable icon {entry.path}')
+                        continue
+                    if text:
+                        self._add_to_index(entry.name[:-len('.png')], text)
+            self._loaded = True
+        logger.info(f'Icon library: {len(self._texts)} icons in {self.path}')
+
+    def match(self, bullet_point):
+        """Key and similarity of the closest stored icon, or (None, 0.0) if none reaches the threshold."""
+        self.load()
+        text = normalize_text(bullet_point)
+        if not text:
+            return None, 0.0
+        with self._lock:
+            best_key, best_score = self.key(text), 1.0
+            if best_key not in self._texts:
+                grams = char_ngrams(text)
+                shared = Counter(candidate for gram in grams for candidate in self._index.get(gram, ()))
+                best_key, best_score = None, 0.0
+                for candidate, count in shared.items():
+                    score = 2 * count / (len(grams) + self._ngrams[candidate])
+                    if score > best_score:
+                        best_key, best_score = candidate, score
+        if best_score < self.threshold:
+            return None, best_score
+        return best_key, best_score
+
+    def get(self, bullet_point):
+        """The stored icon for a bullet point that reads like this one, as an RGBA image, or None."""
+        key, _ = self.match(bullet_point)
+        icon = None
+        if key is not None:
+            path = self._file_path(key)
+            try:
+                with Image.open(path) as img:
+                    icon = img.convert('RGBA')
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another worker since the lookup
+                with self._lock:
+                    self._remove_from_index(key)
+        with self._lock:
+            if icon is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return icon
+
+    def put(self, bullet_point, icon):
+        text = normalize_text(bullet_point)
+        if not text:
+            return
+        self.load()
+        os.makedirs(self.path, exist_ok=True)
+        key = self.key(text)
+        info = PngInfo()
+        info.add_text(TEXT_CHUNK, text)
+        buffer = BytesIO()
+        icon.save(buffer, format='PNG', pnginfo=info)
+        path = self._file_path(key)
+        atomic_write(path, buffer.getvalue())
+        with self._lock:
+            if key not in self._texts:
+                self._add_to_index(key, text)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        with self._evict_lock:
+            removed = evict_oldest(self.path, self.max_bytes, keep)
+        with self._lock:
+            for path in removed:
+                self._remove_from_index(os.path.basename(path)[:-len('.png')])
+
+    def __len__(self):
+        return len(self._texts)
+
+
+icon_library = IconLibrary('db/icon_library/')
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from io import BytesIO
+
+import aiohttp
+from PIL import Image
+
+from src.engine.result_cache import atomic_write
+
+logger = logging.getLogger('tg_main')
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class ImageFetcher:
+    """Downloads product photos once, over a shared connection pool, and keeps them on disk.
+
+    Cached copies are revalidated with ETag / Last-Modified. Concurrent fetches of the
+    same URL share one download. Downloads over `max_bytes` or decoding to more than
+    `max_pixels` are rejected with ImageTooLarge. Each photo is stored as `<hash>.img` with its
+    headers in `<hash>.json`; eviction removes the two together, oldest photo first.
+    """
+    cache_path: str
+    cache_max_bytes: int
+    max_bytes: int
+    max_pixels: int
+
+    def __init__(self, cache_path, cache_max_bytes, max_bytes=20 * 2 ** 20, max_pixels=40_000_000,
+                 timeout=30, max_connections=20):
+        self.cache_path = cache_path
+        self.cache_max_bytes = cache_max_bytes
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._session = None
+        self._in_flight = {}
+        self._evict_lock = threading.Lock()
+
+    def configure(self, cache_path, cache_max_bytes, max_bytes, max_pixels):
+        self.cache_path = cache_path
+        self.cache_max_bytes = cache_max_bytes
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch(self, url):
+        task = self._in_flight.get(url)
+        if task is None:
+            task = self._in_flight[url] = asyncio.ensure_future(self._fetch(url))
+            task.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        # A cancelled waiter must not cancel the download the other waiters share
+        return await asyncio.shield(task)
+
+    def _paths(self, url):
+        data_path = os.path.join(self.cache_path, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.img')
+        return data_path, self._meta_path(data_path)
+
+    @staticmethod
+    def _meta_path(data_path):
+        return data_path[:-len('.img')] + '.json'
+
+    def _read_cached(self, url):
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+        except (FileNotFoundError, ValueError):
+            return None, {}
+        return data, meta
+
+    def _write_cached(self, url, data, meta):
+        os.makedirs(self.cache_path, exist_ok=True)
+        data_path, meta_path = self._paths(url)
+        atomic_write(data_path, data)
+        atomic_write(meta_path, json.dumps(meta).encode('utf-8'))
+        with self._evict_lock:
+            self._evict(keep=data_path)
+
+    def _evict(self, keep=None):
+        """Remove photos with the oldest mtime, each with its metadata, until the cache fits in `cache_max_bytes`."""
+        sizes = {}
+        data_paths = []
+        for entry in os.scandir(self.cache_path):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            stat = entry.stat()
+            sizes[entry.path] = stat.st_size
+            if entry.name.endswith('.img'):
+                data_paths.append((stat.st_mtime, entry.path))
+
+        total = sum(sizes.values())
+        if total <= self.cache_max_bytes:
+            return
+
+        # Metadata whose photo is gone can never be used, it goes before any photo
+        orphans = [(0, path) for path in sizes if path.endswith('.json') and path[:-len('.json')] + '.img' not in sizes]
+        for _, path in orphans + sorted(data_paths):
+            if total <= self.cache_max_bytes:
+                break
+            if path == keep:
+                continue
+            for file_path in (path, self._meta_path(path)) if path.endswith('.img') else (path,):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                total -= sizes.get(file_path, 0)
+        logger.info(f'Evicted {self.cache_path} down to {total / 2 ** 20:.1f} MB')
+
+    def _touch_cached(self, url):
+        for path in self._paths(url):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+    async def _fetch(self, url):
+        cached, meta = await asyncio.to_thread(self._read_cached, url)
+
+        headers = {}
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        async with self._get_session().get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                await asyncio.to_thread(self._touch_cached, url)
+                return cached
+            response.raise_for_status()
+
+            if response.content_length and response.content_length > self.max_bytes:
+                raise ImageTooLarge(f'{url} is {response.content_length} bytes')
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                buffer.extend(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise ImageTooLarge(f'{url} is over {self.max_bytes} bytes')
+            data = bytes(buffer)
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+
+        self.check_pixels(data)
+        await asyncio.to_thread(self._write_cached, url, data, meta)
+        return data
+
+    def check_pixels(self, data):
+        # Only parses the header, the pixels are not decoded here
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+        if width * height > self.max_pixels:
+            raise ImageTooLarge(f'Image is {width}x{height} pixels')
+
+
+image_fetcher = ImageFetcher('db/image_cache/', 500 * 2 ** 20)
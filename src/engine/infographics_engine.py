@@ -1,22 +1,25 @@
-from PIL import Image, ImageOps
-import requests
+from PIL import Image, ImageDraw, ImageOps
 from io import BytesIO
 from typing import Union
-import rembg
 import io
 import base64
-import numpy as np
+import hashlib
 import json
+import math
 import re
+import asyncio
+import time
 
-import requests
-import uuid
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from src.engine.cutout import cutout_batcher, apply_mask_and_crop, mask_bbox, MODEL_INPUT_SIZE
+from src.engine.templates import background_templates
+from src.engine.result_cache import infographic_cache
+from src.engine.icon_library import icon_library
+from src.engine.image_fetcher import image_fetcher
+from src.client_library.fusionbrain.FusionBrainClient import FusionBrainClient
+from src.client_library.gigachat.GigaChatClient import GigaChatClient
+from src.utils.async_cache import AsyncTTLCache
+from src.utils.metrics import render_stage_seconds, render_seconds
 
-background_url = 'background.PNG'#'https://www.ergogrips.net/wp-content/uploads/2016/06/ergo-background-2.jpg'
-#'https://divnil.com/wallpaper/ipad/img/app/4/a/4abdace74f6175bcb6d262b90f05c9fa_cea1cefe51dd3a0094bb2fc5b9c24391_raw.jpg'
-#https://freevector-images.s3.amazonaws.com/uploads/vector/preview/31503/abstract-blocks-blue-main.jpg'
 img_source = 'https://eco-dush.ru/upload/iblock/dd1/dd12186acee71ef2cadaccc647e93bb7.jpg'
 
 product_title = 'Электронная крышка-биде для унитаза Bidetko BK-688'
@@ -34,23 +37,38 @@ description = '''Электронная крышка-биде для унита
 Вы по достоинству оцените соотношение цены и высокого корейского качества. Электронное биде прошло сертификацию, имеет все необходимые документы и гарантию производителя 1 год.'''
 
 
-ICON_GENERATOR_PROMPT = 'маленькая цветастая иконка для буллет поинта "%s"'
+# Bump whenever a change to the renderer changes the pictures it produces, to invalidate cached results
+RENDER_VERSION = '3'
+
+# Layout of the infographic: the product photo takes the right part of the canvas, bullet points the left one
+CANVAS_SIZE = (1000, 1000)
+PRODUCT_POSITION_TO_RIGHT_RATIO = 0.45
+PRODUCT_MARGIN_RATIO = 0.01
 
-def download_image(url: str) -> Image.Image:
-    """Download an image from a URL and return it as a PIL image."""
-    response = requests.get(url)
-    response.raise_for_status()
-    return Image.open(BytesIO(response.content))
+ICON_GENERATOR_PROMPT = 'маленькая цветастая иконка для буллет поинта "%s"'
 
-def load_image(source: str) -> Image.Image:
-    """Load an image from a URL or a local file."""
+def read_image_bytes(path: str) -> bytes:
+    """Read encoded image bytes from a local file."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        raise Exception('The provided file path does not exist.')
+
+async def load_image_bytes(source: Union[str, bytes], run_blocking=asyncio.to_thread) -> bytes:
+    """Get encoded image bytes from a URL, a local file, or pass them through if they already are bytes."""
+    if isinstance(source, bytes):
+        return source
     if source.startswith('http://') or source.startswith('https://'):
-        return download_image(source)
-    else:
-        try:
-            return Image.open(source)
-        except FileNotFoundError:
-            raise Exception('The provided file path does not exist.')
+        return await image_fetcher.fetch(source)
+    return await run_blocking(read_image_bytes, source)
+
+def product_box_size(background_size, margin_ratio, position_to_right_ratio):
+    """The largest size the product photo can take on the background."""
+    margin = int(min(background_size) * margin_ratio)
+    max_width = int(background_size[0] * (1 - position_to_right_ratio)) - margin * 2
+    max_height = background_size[1] - (2 * margin)
+    return max_width, max_height
 
 def place_image_on_background(
     transparent_image: Image.Image, 
@@ -62,8 +80,7 @@ def place_image_on_background(
 
     # Determine maximum size for the transparent image, considering the margin
     margin = int(min(background.size) * margin_ratio)
-    max_width = int(background.width * (1 - position_to_right_ratio)) - margin * 2
-    max_height = background.height - (2 * margin)
+    max_width, max_height = product_box_size(background.size, margin_ratio, position_to_right_ratio)
     
     # Calculate resize ratio for the transparent image
     width_based = (max_width / transparent_image.width) < (max_height / transparent_image.height)
@@ -83,46 +100,37 @@ def place_image_on_background(
     background.paste(transparent_image, (x, y), transparent_image)
     return background
 
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-import textwrap
-
-def add_blurred_shadow(draw, position, text, font, shadow_blur=5, shadow_color='black'):
-    # Create a temporary image to draw shadows on
-    temp_img = Image.new('RGBA', draw.im.size, (0, 0, 0, 0))
-    temp_draw = ImageDraw.Draw(temp_img)
-    
-    # Draw text multiple times with offsets to create a shadow effect
-    offsets = [(x, y) for x in range(-shadow_blur, shadow_blur+1, 2) for y in range(-shadow_blur, shadow_blur+1, 2)]
-    for offset in offsets:
-        shadow_position = (position[0] + offset[0], position[1] + offset[1])
-        temp_draw.text(shadow_position, text, font=font, fill=shadow_color)
-    
-    # Apply a blur filter to the shadows
-    temp_img = temp_img.filter(ImageFilter.GaussianBlur(shadow_blur))
-    
-    # Paste the blurred shadow onto the original image
-    draw.bitmap((0, 0), temp_img, fill=None)
-
-def add_bullet_points_to_image(img, bullet_points, icons, font_path='Roboto-Bold.ttf', font_size=50, spacing=20):
-    bullet_points = [textwrap.fill(bullet_point, 20) for bullet_point in bullet_points]
-    
-    # Load the image
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype(font_path, font_size)
+from src.engine.text_layout import fit_text_blocks, get_font, get_metrics
+from src.engine.shadows import add_blurred_shadow
 
+def add_bullet_points_to_image(img, bullet_points, icons, font_path='Roboto-Bold.ttf', font_size=50, spacing=20,
+                               column_right_ratio=0.45):
     # Starting positions
     x_position = 140  # Increase x_position to make room for icons
     y_position = 50
     rectangle_margin = 15  # Margin around the text inside the rectangle
     icon_size = (80, 80)  # Define the size for the icons
 
+    # Pick the largest font size (up to font_size) at which the bullet points fit the left column
+    row_gap = spacing + 2 * rectangle_margin
+    max_width = int(img.width * column_right_ratio) - x_position - rectangle_margin
+    max_height = img.height - 2 * y_position
+    font_size, blocks = fit_text_blocks(bullet_points, font_path, max_width, max_height, row_gap,
+                                        max_size=font_size)
+    font = get_font(font_path, font_size)
+    metrics = get_metrics(font_path, font_size)
+
+    draw = ImageDraw.Draw(img)
+
     # Iterate over the bullet points and their corresponding icons
-    for point, icon in zip(bullet_points, icons):
+    for lines, icon in zip(blocks, icons):
+        point = '\n'.join(lines)
+
         # Resize icon
         icon = icon.resize(icon_size, Image.LANCZOS)
 
         # Calculate the y position of the icon to align it with the text
-        _, _, text_width, text_height = draw.textbbox((0,0), point, font=font)
+        text_height = metrics.block_height(len(lines))
         icon_y_position = y_position + (text_height - icon_size[1]) // 2
 
         # Place the icon on the image
@@ -135,137 +143,77 @@ def add_bullet_points_to_image(img, bullet_points, icons, font_path='Roboto-Bold
         draw.text((x_position, y_position), point, font=font, fill='black')
 
         # Update the y position for the next point
-        y_position += text_height + spacing + 2 * rectangle_margin
+        y_position += text_height + row_gap
 
     # Return the edited image
     return img
 
-import json
-import time
 
-import requests
-
-
-class Text2ImageAPI:
-
-    def __init__(self, url, api_key, secret_key):
-        self.URL = url
-        self.AUTH_HEADERS = {
-            'X-Key': f'Key {api_key}',
-            'X-Secret': f'Secret {secret_key}',
-        }
-
-    def get_model(self):
-        response = requests.get(self.URL + 'key/api/v1/models', headers=self.AUTH_HEADERS)
-        data = response.json()
-        return data[0]['id']
-
-    def generate(self, prompt, model, images=1, width=768, height=768):
-        params = {
-            "type": "GENERATE",
-            "numImages": images,
-            "width": width,
-            "height": height,
-            "generateParams": {
-                "query": f"{prompt}"
-            }
-        }
-
-        data = {
-            'model_id': (None, model),
-            'params': (None, json.dumps(params), 'application/json')
-        }
-        response = requests.post(self.URL + 'key/api/v1/text2image/run', headers=self.AUTH_HEADERS, files=data)
-        data = response.json()
-        return data['uuid']
-
-    def check_generation(self, request_id, attempts=10, delay=10):
-        while attempts > 0:
-            response = requests.get(self.URL + 'key/api/v1/text2image/status/' + request_id, 
-                                    headers=self.AUTH_HEADERS)
-            data = response.json()
-            if data['status'] == 'DONE':
-                return data['images']
-
-            attempts -= 1
-            time.sleep(delay)
-
-            
-def get_icons_for_bullet_points(product_title, bullet_points):
-    api = Text2ImageAPI('https://api-key.fusionbrain.ai/', 
-                        '2D5AE6D5A08AF7B3ED8A2CF3067651D7', '88E3E9E29C4744A5A6123CAAF8D3A867')
-    model_id = api.get_model()
-    
-    template = ICON_GENERATOR_PROMPT
-    prompts = [template % p for p in bullet_points]
-    uuids = [api.generate(prompt, model_id) for prompt in prompts]
-    images = [api.check_generation(uuid)[0] for uuid in uuids]
+text2image = FusionBrainClient('https://api-key.fusionbrain.ai/',
+                               '2D5AE6D5A08AF7B3ED8A2CF3067651D7', '88E3E9E29C4744A5A6123CAAF8D3A867')
 
-    output_images = []
-    
-    for base64_image in images:
-        image_data = base64.b64decode(base64_image)
-        image = Image.open(io.BytesIO(image_data))
-        image_array = np.array(image)
-        
-        img = Image.fromarray(image_array).resize((200, 200))
-        output = remove_background_and_crop(img)
-        output_images.append(output)
-    return output_images
-
-def gigachat_auth():
-    # URL and headers
-    url = 'https://ngw.devices.sberbank.ru:9443/api/v2/oauth'
-    bearer = 'OTk3NDg4ZjYtNThlZi00NGUyLTgxNjMtMDhmMTRkZjc1YzY2OjI1MmI0Y2JlLTE3ZjYtNDIyMC1hZjFmLWJmYjAzZmE4OTk0MA=='
-    headers = {
-        'Authorization': f'Bearer {bearer}',
-        'RqUID': str(uuid.uuid4()),
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    data = {
-        'scope': 'GIGACHAT_API_PERS'
-    }
-
-    response = requests.post(url, headers=headers, data=data, verify=False)
-
-    if response.status_code == 200:
-        access_token = response.json()['access_token']
-    else:
-        print('Failed with status code:', response.status_code)
-        print(response.json())
-    return access_token
 
-def gigachat_complete(prompt):
-    access_token = gigachat_auth()
-    
-    url = 'https://gigachat.devices.sberbank.ru/api/v1/chat/completions'
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
-
-    payload = {
-        "model": "GigaChat:latest",
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "temperature": 0.7
-    }
-
-    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-    response = requests.post(url, headers=headers, data=data, verify=False)
-
-    if response.status_code == 200:
-        reply = response.json()['choices'][0]['message']['content']
-    else:
-        print('Failed with status code:', response.status_code)
-        print(response.text)
-    return reply
+def cut_out_icons(base64_images):
+    with render_stage_seconds.time(stage='icon_cutout'):
+        icons = [Image.open(io.BytesIO(base64.b64decode(base64_image))).resize((200, 200))
+                 for base64_image in base64_images]
+        # All icons go through background removal in one batched inference call
+        return cutout_batcher.cutout(icons)
+
+
+def find_library_icons(bullet_points):
+    with render_stage_seconds.time(stage='icon_lookup'):
+        return [icon_library.get(p) for p in bullet_points]
+
+
+def cut_out_and_store_icons(bullet_points, base64_images):
+    icons = cut_out_icons(base64_images)
+    for bullet_point, icon in zip(bullet_points, icons):
+        icon_library.put(bullet_point, icon)
+    return icons
+
+
+async def get_icons_for_bullet_points(product_title, bullet_points, run_blocking=asyncio.to_thread):
+    # Features like "гарантия 1 год" recur across products, only bullet points unlike any stored one are generated
+    icons = await run_blocking(find_library_icons, bullet_points)
+    missing = [i for i, icon in enumerate(icons) if icon is None]
+    if not missing:
+        return icons
+
+    prompts = [ICON_GENERATOR_PROMPT % bullet_points[i] for i in missing]
+    with render_stage_seconds.time(stage='icon_generation'):
+        images = await text2image.generate_images(prompts)
+    generated = await run_blocking(cut_out_and_store_icons, [bullet_points[i] for i in missing], images)
+    for i, icon in zip(missing, generated):
+        icons[i] = icon
+    return icons
+
+
+gigachat = GigaChatClient(
+    'OTk3NDg4ZjYtNThlZi00NGUyLTgxNjMtMDhmMTRkZjc1YzY2OjI1MmI0Y2JlLTE3ZjYtNDIyMC1hZjFmLWJmYjAzZmE4OTk0MA=='
+)
+
+
+GIGACHAT_MODEL = 'GigaChat:latest'
+
+# GigaChat answers by model, prompt version and prompt, so the same SKU or a double tap costs one call
+llm_responses = AsyncTTLCache(ttl=24 * 3600, max_items=10000)
+
+
+def llm_cache_key(model, prompt_version, prompt):
+    return hashlib.sha256(json.dumps([model, prompt_version, prompt], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+async def gigachat_complete(prompt, prompt_version=None):
+    """Complete `prompt` with GigaChat.
+
+    With a `prompt_version` the answer is cached, and concurrent calls with the same prompt share
+    one request. Bump the version when the prompt template changes.
+    """
+    if prompt_version is None:
+        return await gigachat.complete(prompt, model=GIGACHAT_MODEL)
+    key = llm_cache_key(GIGACHAT_MODEL, prompt_version, prompt)
+    return await llm_responses.get_or_load(key, lambda: gigachat.complete(prompt, model=GIGACHAT_MODEL))
 
 
 EXTRACT_FEATURES_PROMPT = '''
@@ -279,32 +227,159 @@ EXTRACT_FEATURES_PROMPT = '''
 Конец
 
 %s'''
+EXTRACT_FEATURES_PROMPT_VERSION = 'extract_features:1'
 
-def get_bullet_points(description):
-    completion = gigachat_complete(EXTRACT_FEATURES_PROMPT % description)
+async def get_bullet_points(description):
+    completion = await gigachat_complete(EXTRACT_FEATURES_PROMPT % description, EXTRACT_FEATURES_PROMPT_VERSION)
     pattern = r'\d\.\s*(.+)'
     matches = re.findall(pattern, completion)
     return matches[:5]
 
-def remove_background_and_crop(img):
-    output = rembg.remove(img)
-    alpha = output.getchannel('A')
-    bbox = alpha.getbbox()
-    res = output.crop(bbox)
-    return res
-
-def get_infographic_for_product(image_url, product_title, product_description):
-    bullet_points = get_bullet_points(product_description)
-    icons = get_icons_for_bullet_points(product_title, bullet_points)
-
-    background = load_image(background_url).resize((1000, 1000))
-    transparent_image = load_image(image_url)
-    transparent_image = remove_background_and_crop(transparent_image)
-
-    final_image = place_image_on_background(transparent_image, background, position_to_right_ratio=0.45, 
-                                            margin_ratio=0.01)
-    final_image = add_bullet_points_to_image(final_image, bullet_points, icons)
-
-    path = 'tmp.png'
-    final_image.save(path)
-    return path
+def decode_for_layout(image_bytes, target_size):
+    """Decode a photo no larger than needed to cover `target_size`, upright according to its EXIF orientation.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale, other formats are reduced by an integer
+    factor before the final resampling, so large photos are never fully resampled.
+    """
+    img = Image.open(BytesIO(image_bytes))
+    target_width, target_height = target_size
+    # Orientations 5-8 are rotated by 90 degrees, the stored image has width and height swapped
+    if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        target_width, target_height = target_height, target_width
+
+    scale = max(target_width / img.width, target_height / img.height)
+    if scale < 1:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img.draft('RGB', size)
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    return ImageOps.exif_transpose(img)
+
+
+def cut_out_product(image_bytes):
+    """Cut the product out of its photo, decoded no larger than the product itself needs in the layout.
+
+    The mask comes from a preview decoded at model resolution. The photo is then decoded so that
+    the product's bounding box, not the whole frame, covers the layout box, in full if need be,
+    and the same mask is applied to it.
+    """
+    box_width, box_height = product_box_size(CANVAS_SIZE, PRODUCT_MARGIN_RATIO, PRODUCT_POSITION_TO_RIGHT_RATIO)
+    with render_stage_seconds.time(stage='decode_preview'):
+        preview = decode_for_layout(image_bytes, MODEL_INPUT_SIZE)
+    with render_stage_seconds.time(stage='mask'):
+        mask = cutout_batcher.masks([preview])[0]
+
+    left, top, right, bottom = mask_bbox(mask)
+    # A model pixel of slack on each side, the mask spreads a little when it is scaled up
+    width_fraction = min(1.0, right - left + 2 / mask.shape[1])
+    height_fraction = min(1.0, bottom - top + 2 / mask.shape[0])
+    target_size = (math.ceil(box_width / width_fraction), math.ceil(box_height / height_fraction))
+    with render_stage_seconds.time(stage='decode'):
+        img = decode_for_layout(image_bytes, target_size)
+    with render_stage_seconds.time(stage='cutout'):
+        return apply_mask_and_crop(img, mask)
+
+
+def compose_infographic(transparent_image, bullet_points, icons, template='default'):
+    with render_stage_seconds.time(stage='place_image'):
+        background = background_templates.get(template, CANVAS_SIZE)
+        final_image = place_image_on_background(transparent_image, background,
+                                                position_to_right_ratio=PRODUCT_POSITION_TO_RIGHT_RATIO,
+                                                margin_ratio=PRODUCT_MARGIN_RATIO)
+    with render_stage_seconds.time(stage='bullet_point_text'):
+        return add_bullet_points_to_image(final_image, bullet_points, icons,
+                                          column_right_ratio=PRODUCT_POSITION_TO_RIGHT_RATIO)
+
+
+# Encoder settings and file extension per output format
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'png'),
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+
+# (default, lowest, highest) quality per output format: the zlib level for PNG, the encoder quality for WebP and JPEG
+OUTPUT_QUALITY = {
+    'png': (6, 0, 9),
+    'webp': (90, 0, 100),
+    'jpeg': (90, 0, 100),
+}
+
+
+def resolve_quality(output_format, quality=None):
+    """The format's default quality for None, otherwise `quality` checked against the format's range."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format {output_format!r}, expected one of {", ".join(OUTPUT_FORMATS)}')
+    default, lowest, highest = OUTPUT_QUALITY[output_format]
+    if quality is None:
+        return default
+    if not lowest <= quality <= highest:
+        raise ValueError(f'Quality {quality} is out of range {lowest}-{highest} for {output_format}')
+    return quality
+
+
+def encode_image(image, output_format='png', quality=None):
+    """Encode the image in memory. `quality` is the zlib level (0-9) for PNG and 0-100 for WebP and JPEG."""
+    quality = resolve_quality(output_format, quality)
+    pil_format, _ = OUTPUT_FORMATS[output_format]
+    buffer = BytesIO()
+    if output_format == 'png':
+        image.save(buffer, format=pil_format, compress_level=quality)
+    elif output_format == 'webp':
+        image.save(buffer, format=pil_format, quality=quality, method=4)
+    else:
+        image.convert('RGB').save(buffer, format=pil_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def render_and_store(cache_key, transparent_image, bullet_points, icons, template='default',
+                     output_format='png', quality=None):
+    final_image = compose_infographic(transparent_image, bullet_points, icons, template)
+    with render_stage_seconds.time(stage='encode'):
+        data = encode_image(final_image, output_format, quality)
+    with render_stage_seconds.time(stage='cache_store'):
+        infographic_cache.put(cache_key, data, OUTPUT_FORMATS[output_format][1])
+    return data
+
+
+async def get_infographic_for_product(product_image, product_title, product_description,
+                                      template='default', output_format='png', quality=None,
+                                      run_blocking=asyncio.to_thread, progress=None):
+    """Render the infographic and return it encoded in `output_format`.
+
+    `product_image` is the encoded product photo, or a URL or path to fetch it from.
+
+    Network stages are awaited directly, CPU-bound stages go through `run_blocking(fn, *args)`.
+    `progress`, if given, is called with the name of each stage as it starts.
+    Each stage's duration goes to the `render_stage_seconds` histogram.
+    """
+    if progress is None:
+        progress = lambda stage: None
+    quality = resolve_quality(output_format, quality)
+    start = time.perf_counter()
+
+    progress('bullet_points')
+    with render_stage_seconds.time(stage='bullet_points'):
+        bullet_points = await get_bullet_points(product_description)
+    with render_stage_seconds.time(stage='load_image'):
+        image_bytes = await load_image_bytes(product_image, run_blocking)
+
+    # Same photo, same bullet points and same renderer give the same picture, skip the paid icon generation
+    extension = OUTPUT_FORMATS[output_format][1]
+    cache_key = infographic_cache.key(image_bytes, bullet_points, [template, output_format, quality],
+                                      RENDER_VERSION)
+    cached = await run_blocking(infographic_cache.get, cache_key, extension)
+    if cached:
+        render_seconds.observe(time.perf_counter() - start, cache='hit')
+        return cached
+
+    progress('icons')
+    icons = await get_icons_for_bullet_points(product_title, bullet_points, run_blocking)
+
+    progress('cutout')
+    transparent_image = await run_blocking(cut_out_product, image_bytes)
+
+    progress('compose')
+    infographic = await run_blocking(render_and_store, cache_key, transparent_image, bullet_points, icons,
+                                     template, output_format, quality)
+    render_seconds.observe(time.perf_counter() - start, cache='miss')
+    return infographic
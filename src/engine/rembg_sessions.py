@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+
+import onnxruntime as ort
+import rembg
+from PIL import Image
+from rembg.sessions import sessions_class
+from rembg.sessions.u2net import U2netSession
+
+logger = logging.getLogger('tg_main')
+
+# cutout.py feeds the model with u2net's input size and normalization, other rembg models would get wrong masks
+U2NET_MODELS = ('u2net', 'u2netp', 'u2net_human_seg', 'silueta')
+
+
+def check_model(model_name):
+    if model_name not in U2NET_MODELS:
+        raise ValueError(f'Unsupported rembg_model {model_name!r}, expected one of {", ".join(U2NET_MODELS)}')
+
+
+class RembgSessionManager:
+    """Keeps one onnxruntime session per rembg model for the whole process.
+
+    Sessions are thread-safe, so every render worker shares them. Intra-op threads
+    are capped so that concurrent workers do not oversubscribe the cores.
+    """
+    model_name: str
+    intra_op_threads: int
+
+    def __init__(self, model_name='u2net', intra_op_threads=1):
+        self.model_name = model_name
+        self.intra_op_threads = intra_op_threads
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, model_name, intra_op_threads):
+        check_model(model_name)
+        with self._lock:
+            self.model_name = model_name
+            self.intra_op_threads = intra_op_threads
+            self._sessions.clear()
+
+    def get(self, model_name=None):
+        model_name = model_name or self.model_name
+        session = self._sessions.get(model_name)
+        if session is not None:
+            return session
+
+        with self._lock:
+            if model_name not in self._sessions:
+                self._sessions[model_name] = self._create(model_name)
+            return self._sessions[model_name]
+
+    def register(self, model_name, session):
+        """Use `session` for `model_name` instead of loading the model, e.g. a stand-in for benchmarks."""
+        with self._lock:
+            self._sessions[model_name] = session
+
+    def _create(self, model_name):
+        check_model(model_name)
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = 1
+
+        session_class = U2netSession
+        for sc in sessions_class:
+            if sc.name() == model_name:
+                session_class = sc
+                break
+
+        logger.info(f'Loading rembg model {model_name} ({self.intra_op_threads} intra-op threads)')
+        return session_class(model_name, sess_opts, None)
+
+    def warm_up(self):
+        # The first run allocates onnxruntime buffers, do it before real requests arrive
+        rembg.remove(Image.new('RGB', (64, 64)), session=self.get())
+
+
+def default_intra_op_threads(render_workers):
+    return max(1, (os.cpu_count() or 1) // render_workers)
+
+
+rembg_sessions = RembgSessionManager()
@@ -0,0 +1,101 @@
+import asyncio
+import contextlib
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('tg_main')
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderQueue:
+    """Runs render jobs, keeping their blocking stages on a bounded worker pool off the event loop."""
+    executor: ThreadPoolExecutor
+    max_pending: int
+    pending: int
+
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.max_pending = max_pending
+        self.pending = 0
+        self._active = 0
+        self._idle = None
+
+    def is_full(self):
+        return self.pending >= self.max_pending
+
+    async def submit(self, job, *args, progress=None, **kwargs):
+        """Run the render coroutine `job(*args, **kwargs, run_blocking=..., progress=...)` and return its result.
+
+        The job awaits its blocking stages through `run_blocking(fn, *args)`, which runs
+        them on the worker pool. `progress` is an optional coroutine function taking a
+        stage name. The job may report stages from the loop or from a worker thread; the
+        reports are awaited on the event loop one by one, in the order they were made.
+        """
+        if self.is_full():
+            raise RenderQueueFull()
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            async with self.tracked():
+                return await job(*args, **kwargs, run_blocking=self.run_blocking,
+                                 progress=self._forward_progress(loop, progress))
+        finally:
+            self.pending -= 1
+
+    @contextlib.asynccontextmanager
+    async def tracked(self):
+        """Keep drain() waiting until the block exits, e.g. a handler that still has to send the job's result."""
+        self._active += 1
+        self._idle_event().clear()
+        try:
+            yield
+        finally:
+            self._active -= 1
+            if self._active == 0:
+                self._idle.set()
+
+    def _idle_event(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if self._active == 0:
+                self._idle.set()
+        return self._idle
+
+    async def drain(self, timeout=None):
+        """Wait until every submitted job and tracked block has finished. Returns False if `timeout` ran out first."""
+        try:
+            await asyncio.wait_for(self._idle_event().wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'{self._active} render jobs still running after {timeout}s')
+            return False
+        return True
+
+    async def run_blocking(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def _forward_progress(self, loop, progress):
+        if progress is None:
+            return None
+
+        lock = asyncio.Lock()
+
+        async def report(stage):
+            async with lock:
+                try:
+                    await progress(stage)
+                except Exception:
+                    logger.warning(f'Failed to report render progress "{stage}"', exc_info=True)
+
+        def forward(stage):
+            asyncio.run_coroutine_threadsafe(report(stage), loop)
+
+        return forward
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger('tg_main')
+
+
+def evict_oldest(path, max_bytes, keep=None):
+    """Remove files with the oldest mtime from `path` until it holds at most `max_bytes`. Returns the removed paths."""
+    entries = []
+    total = 0
+    for entry in os.scandir(path):
+        if not entry.is_file() or entry.name.startswith('.'):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    removed = []
+    if total <= max_bytes:
+        return removed
+
+    for _, size, file_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if file_path == keep:
+            continue
+        try:
+            os.remove(file_path)
+            removed.append(file_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    logger.info(f'Evicted {path} down to {total / 2 ** 20:.1f} MB')
+    return removed
+
+
+def atomic_write(path, data):
+    """Write `data` under a unique name next to `path` and rename it, so readers never see a half-written file."""
+    tmp_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class InfographicCache:
+    """Rendered infographics on disk, addressed by a hash of everything that affects the output.
+
+    Hits refresh the file's mtime; when the directory grows past `max_bytes`, the files
+    with the oldest mtime are removed first.
+    """
+    path: str
+    max_bytes: int
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+
+    def configure(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(image_bytes, bullet_points, render_options, render_version):
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(image_bytes).digest())
+        digest.update(json.dumps([bullet_points, render_options, render_version],
+                                 ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _file_path(self, key, extension):
+        return os.path.join(self.path, f'{key}.{extension}')
+
+    def get(self, key, extension='png'):
+        path = self._file_path(key, extension)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data, extension='png'):
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file_path(key, extension)
+        atomic_write(path, data)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        with self._evict_lock:
+            evict_oldest(self.path, self.max_bytes, keep)
+
+
+infographic_cache = InfographicCache('db/infographic_cache/', 500 * 2 ** 20)
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+_masks = OrderedDict()
+_masks_lock = threading.Lock()
+MAX_CACHED_MASKS = 256
+
+# Only used to measure text, never drawn on
+_measure_draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+
+def render_shadow_mask(text, font, shadow_blur):
+    """Rasterize `text` once into a tight alpha mask, thicken it and blur it within its own bounding box.
+
+    Returns the mask and its offset relative to the text position.
+    """
+    left, top, right, bottom = _measure_draw.multiline_textbbox((0, 0), text, font=font)
+    # Room for the thickening and for the blur to fade out
+    pad = 4 * shadow_blur
+    mask = Image.new('L', (right - left + 2 * pad, bottom - top + 2 * pad), 0)
+    ImageDraw.Draw(mask).text((pad - left, pad - top), text, font=font, fill=255)
+
+    # Same grid of offsets the text used to be redrawn at, as a max over shifted copies of one raster
+    alpha = np.asarray(mask)
+    height, width = alpha.shape
+    thick = alpha.copy()
+    for dx in range(-shadow_blur, shadow_blur + 1, 2):
+        for dy in range(-shadow_blur, shadow_blur + 1, 2):
+            dst = thick[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+            src = alpha[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+            np.maximum(dst, src, out=dst)
+
+    shadow = Image.fromarray(thick, mode='L').filter(ImageFilter.GaussianBlur(shadow_blur))
+    return shadow, (left - pad, top - pad)
+
+
+def get_shadow_mask(text, font, shadow_blur):
+    key = (text, font.path, font.size, shadow_blur)
+    with _masks_lock:
+        cached = _masks.get(key)
+        if cached is not None:
+            _masks.move_to_end(key)
+            return cached
+
+    cached = render_shadow_mask(text, font, shadow_blur)
+    with _masks_lock:
+        _masks[key] = cached
+        while len(_masks) > MAX_CACHED_MASKS:
+            _masks.popitem(last=False)
+    return cached
+
+
+def add_blurred_shadow(draw, position, text, font, shadow_blur=5):
+    """Paint the blurred glow behind `text` with the draw's ink, touching only the text's bounding box."""
+    shadow, (dx, dy) = get_shadow_mask(text, font, shadow_blur)
+    draw.bitmap((position[0] + dx, position[1] + dy), shadow, fill=None)
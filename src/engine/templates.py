@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+BACKGROUND_TEMPLATES = {
+    'default': 'background.PNG',
+}
+
+
+class BackgroundTemplateCache:
+    """Decoded and resized background canvases, keyed by (template, size), with LRU eviction.
+
+    `get` hands out copies, so renders can draw on the canvas without touching the cached one.
+    """
+    max_items: int
+
+    def __init__(self, templates, max_items=8):
+        self.templates = templates
+        self.max_items = max_items
+        self._canvases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, template, size):
+        with Image.open(self.templates[template]) as img:
+            canvas = img.resize(size) if img.size != size else img.copy()
+        canvas.load()
+        return canvas
+
+    def get(self, template='default', size=(1000, 1000)):
+        key = (template, tuple(size))
+        with self._lock:
+            canvas = self._canvases.get(key)
+            if canvas is not None:
+                self._canvases.move_to_end(key)
+                return canvas.copy()
+
+        # Decode outside of the lock, a concurrent miss on the same key only costs a duplicate decode
+        canvas = self._load(template, key[1])
+        with self._lock:
+            self._canvases[key] = canvas
+            self._canvases.move_to_end(key)
+            while len(self._canvases) > self.max_items:
+                self._canvases.popitem(last=False)
+        return canvas.copy()
+
+    def preload(self, size=(1000, 1000)):
+        for template in self.templates:
+            self.get(template, size)
+
+
+background_templates = BackgroundTemplateCache(BACKGROUND_TEMPLATES)
@@ -0,0 +1,123 @@
+import threading
+
+from PIL import ImageFont
+
+# FreeType faces are not safe to share between threads, so every render worker gets its own fonts
+_local = threading.local()
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_font(path, size):
+    fonts = getattr(_local, 'fonts', None)
+    if fonts is None:
+        fonts = _local.fonts = {}
+    font = fonts.get((path, size))
+    if font is None:
+        font = fonts[(path, size)] = ImageFont.truetype(path, size)
+    return font
+
+
+class GlyphMetrics:
+    """Per-glyph advance widths of one font at one size, measured once and shared by all workers."""
+    line_height: int
+    line_spacing: int
+
+    def __init__(self, path, size, multiline_spacing=4):
+        # A private font instance, only used under the lock
+        self._font = ImageFont.truetype(path, size)
+        self._lock = threading.Lock()
+        self._advances = {}
+        ascent, descent = self._font.getmetrics()
+        self.line_height = ascent + descent
+        # Same line pitch as ImageDraw.multiline_text
+        self.line_spacing = self._font.getbbox('A')[3] + multiline_spacing
+
+    def advance(self, char):
+        width = self._advances.get(char)
+        if width is None:
+            with self._lock:
+                width = self._advances[char] = self._font.getlength(char)
+        return width
+
+    def width(self, text):
+        return sum(self.advance(char) for char in text)
+
+    def block_height(self, num_lines):
+        return (num_lines - 1) * self.line_spacing + self.line_height
+
+
+def get_metrics(path, size):
+    metrics = _metrics.get((path, size))
+    if metrics is None:
+        with _metrics_lock:
+            metrics = _metrics.get((path, size))
+            if metrics is None:
+                metrics = _metrics[(path, size)] = GlyphMetrics(path, size)
+    return metrics
+
+
+def wrap_text(text, metrics, max_width):
+    """Greedy word wrap by pixel width. Words wider than the line are broken between characters."""
+    space = metrics.advance(' ')
+    lines = []
+    line, line_width = [], 0
+    for word in text.split():
+        word_width = metrics.width(word)
+        if line and line_width + space + word_width <= max_width:
+            line.append(word)
+            line_width += space + word_width
+            continue
+
+        if line:
+            lines.append(' '.join(line))
+        line, line_width = [], 0
+
+        while word_width > max_width and len(word) > 1:
+            cut, cut_width = 1, metrics.advance(word[0])
+            while cut < len(word) and cut_width + metrics.advance(word[cut]) <= max_width:
+                cut_width += metrics.advance(word[cut])
+                cut += 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = metrics.width(word)
+
+        line, line_width = [word], word_width
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+
+def layout_blocks(texts, font_path, font_size, max_width, row_gap):
+    """Wrap every text at `font_size`.
+
+    Returns (lines per text, total height including gaps, whether the widest word fits on a line).
+    """
+    metrics = get_metrics(font_path, font_size)
+    blocks = [wrap_text(text, metrics, max_width) for text in texts]
+    height = sum(metrics.block_height(len(lines)) for lines in blocks) + row_gap * max(len(blocks) - 1, 0)
+    words_fit = all(metrics.width(word) <= max_width for text in texts for word in text.split())
+    return blocks, height, words_fit
+
+
+def fit_text_blocks(texts, font_path, max_width, max_height, row_gap, min_size=20, max_size=50):
+    """Find the largest font size at which all texts, word-wrapped to `max_width`, fit into `max_height`
+    without breaking words.
+
+    Only cached glyph advances are used, nothing is rasterized. Returns (font_size, lines per text);
+    if even `min_size` does not fit, the texts are laid out at `min_size`.
+    """
+    low, high = min_size, max_size
+    best = min_size
+    while low <= high:
+        size = (low + high) // 2
+        _, height, words_fit = layout_blocks(texts, font_path, size, max_width, row_gap)
+        if height <= max_height and words_fit:
+            best = size
+            low = size + 1
+        else:
+            high = size - 1
+
+    blocks, _, _ = layout_blocks(texts, font_path, best, max_width, row_gap)
+    return best, blocks
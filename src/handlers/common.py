@@ -7,7 +7,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.filters import Command
 
-from src.utils.json_utils import load_json, save_json
+from src.utils.shared_state import shared_state
 
 global_config = configobj.ConfigObj('configs/global.ini')
 logger = logging.getLogger('tg_main')
@@ -23,8 +23,6 @@ INTRO_MESSAGE = '''\
 Продукт ООО "ОмниФид" (omnifeed.ru)
 '''
 
-BOT_DB = global_config['bot_db_path']
-
 START_KEYBOARD = ReplyKeyboardMarkup(
     keyboard=[
         [
@@ -54,18 +52,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
     username = message.from_user.username
 
-    bot_db = load_json(BOT_DB)
-    if user_id not in bot_db['ids_to_users_nicknames_map'].keys():
-        bot_db['users_nicknames_to_ids_map'][username] = user_id
-        bot_db['ids_to_users_nicknames_map'][user_id] = username
-        bot_db['user_info'][user_id] = {}
-        bot_db['user_info'][user_id]['num_credits'] = 2
-        bot_db['user_info'][user_id]['ozon_token'] = ''
-        bot_db['user_info'][user_id]['email'] = ''
-        
-        save_json(BOT_DB, bot_db)
+    is_new_user = await shared_state.user_store.add_user(user_id, username, num_credits=2)
+    if is_new_user:
         logger.info(
-            f'User @{username}({user_id}): added to users_nicknames_to_ids_map'
+            f'User @{username}({user_id}): added to users'
         )
 
     await message.answer(INTRO_MESSAGE, reply_markup=START_KEYBOARD)
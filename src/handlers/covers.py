@@ -3,7 +3,6 @@ import logging
 import os
 import configobj
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import uuid
 import shutil
 import traceback
@@ -12,22 +11,41 @@ import traceback
 from aiogram import types, Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, FSInputFile, URLInputFile
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, FSInputFile, BufferedInputFile
 from aiogram.filters import Command
 
-from src.utils.json_utils import load_json, save_json
 from src.handlers.common import START_KEYBOARD
-from src.engine.infographics_engine import get_infographic_for_product, gigachat_complete
+from src.engine.infographics_engine import get_infographic_for_product, gigachat_complete, OUTPUT_FORMATS, \
+    resolve_quality
+from src.engine.render_queue import RenderQueue, RenderQueueFull
+from src.engine.image_fetcher import image_fetcher, ImageTooLarge
 from src.adapters.exceptions import ProductNotFound
 from src.adapters.OzonAdapter import OzonAdapter
-
-executor = ThreadPoolExecutor()
+from src.utils.metrics import render_stage_seconds
+from src.utils.shared_state import shared_state
 
 global_config = configobj.ConfigObj('configs/global.ini')
 logger = logging.getLogger('tg_main')
-BOT_DB = global_config['bot_db_path']
 covers_router = Router()
 
+render_queue = RenderQueue(workers=int(global_config['render_workers']),
+                           max_pending=int(global_config['render_queue_size']))
+
+INFOGRAPHIC_FORMAT = global_config['infographic_format']
+INFOGRAPHIC_QUALITY = resolve_quality(INFOGRAPHIC_FORMAT, int(global_config['infographic_quality']))
+
+IMPROVE_DESCRIPTION_PROMPT = 'Напиши идеальное длинное описание товара с буллет поинтами. \n\nНазвание товара:\n%s\nСтарое описание товара:\n%sНовое описание товара:\n'
+IMPROVE_DESCRIPTION_PROMPT_VERSION = 'improve_description:1'
+
+RENDER_QUEUE_FULL_MESSAGE = 'Сейчас создается слишком много инфографик, попробуйте через пару минут'
+
+RENDER_STAGE_MESSAGES = {
+    'bullet_points': 'Выделяем ключевые характеристики товара...',
+    'icons': 'Рисуем иконки для характеристик...',
+    'cutout': 'Вырезаем товар с фотографии...',
+    'compose': 'Собираем инфографику...',
+}
+
 
 class CoversState(StatesGroup):
     token_edit = State()
@@ -88,9 +106,7 @@ async def cmd_add_ozon_token_followup(message: types.Message, state: FSMContext)
         await message.answer('Токен добавлен, Вы можете приступить к созданию видеообложек '
                              'товаров!', reply_markup=START_KEYBOARD)
         
-        bot_db = load_json(BOT_DB)
-        bot_db['user_info'][str(message.from_user.id)]['ozon_token'] = ozon_token
-        save_json(BOT_DB, bot_db)
+        await shared_state.user_store.set_ozon_token(message.from_user.id, ozon_token)
 
         await state.set_state()
     else:
@@ -111,8 +127,8 @@ async def request_token(message: types.Message, state: FSMContext):
 
 @covers_router.message(F.text == 'Выбрать продукт на Озон')
 async def cmd_choose_ozon_product(message: types.Message, state: FSMContext):
-    bot_db = load_json(BOT_DB)
-    if bot_db['user_info'][str(message.from_user.id)]['ozon_token']:
+    user = await shared_state.user_store.get_user(message.from_user.id)
+    if user and user['ozon_token']:
         await message.answer('Напишите артикул товара, чтобы мы смогли изучить карточку:', reply_markup=CANCEL_KEYBOARD)
         await state.set_state(CoversState.choose_sku)
     else:
@@ -120,46 +136,30 @@ async def cmd_choose_ozon_product(message: types.Message, state: FSMContext):
 
 
 async def choose_sku_and_load_data(message: types.Message, state: FSMContext):
-    bot_db = load_json(BOT_DB)
-    ozon_token = bot_db['user_info'][str(message.from_user.id)]['ozon_token']
-    ozon_adapter = OzonAdapter(ozon_token)
+    user = await shared_state.user_store.get_user(message.from_user.id)
+    ozon_adapter = OzonAdapter(user['ozon_token'])
 
     sku = message.text
     cannot_access_store = False
     try:
-        product = await ozon_adapter.get_product_data(sku)
+        product = await ozon_adapter.load_product_card(sku)
     except ProductNotFound:
         product = None
     except:
+        product = None
         cannot_access_store = True
 
-    if product:
-        product_images = product['images']
-
-    try:
-        description = await ozon_adapter.get_product_description(sku)
-    except ProductNotFound:
-        description = None
-    except:
-        cannot_access_store = True
-
-    product_name = ''
-    product_description = ''
-    if description:
-        product_name = description['name']
-        product_description = description['description']
-
     if cannot_access_store:
         await message.answer('Не смогли зайти в магазин, проверьте что введенный токен актуален', reply_markup=CANCEL_KEYBOARD)
     elif product is None:
         await message.answer('Не смогли найти такой товар в магазине', reply_markup=CANCEL_KEYBOARD)
-    elif len(product_images) == 0:
+    elif len(product['images']) == 0:
         await message.answer('У выбранного товара нет изображений', reply_markup=CANCEL_KEYBOARD)
     else:
         await state.update_data(sku=sku,
-                                images=product_images,
-                                name=product_name,
-                                description=product_description
+                                images=product['images'],
+                                name=product['name'],
+                                description=product['description']
                                 )
         await message.answer('Товар найден')
         return True
@@ -182,23 +182,61 @@ async def improve_product_description(message: types.Message, state: FSMContext)
     product_description = data['description']
     product_image = data['images']
 
-    prompt_template = 'Напиши идеальное длинное описание товара с буллет поинтами. \n\nНазвание товара:\n%s\nСтарое описание товара:\n%sНовое описание товара:\n'
-    answer = gigachat_complete(prompt_template % (product_name, product_description))
+    answer = await gigachat_complete(IMPROVE_DESCRIPTION_PROMPT % (product_name, product_description),
+                                     IMPROVE_DESCRIPTION_PROMPT_VERSION)
     await message.answer(answer)
 
 @covers_router.message(F.text == 'Создать инфографику')
 async def create_infographics(message: types.Message, state: FSMContext):
+    # Shutdown waits for the whole handler, the infographic is sent only after its render job has returned
+    async with render_queue.tracked():
+        await render_and_send_infographic(message, state)
+
+
+async def render_and_send_infographic(message: types.Message, state: FSMContext):
     data = await state.get_data()
     product_name = data['name']
     product_description = data['description']
     product_image = data['images'][0]
     
-    image = URLInputFile(product_image, filename='sas2.png')
+    if render_queue.is_full():
+        await message.answer(RENDER_QUEUE_FULL_MESSAGE, reply_markup=CHOOSE_KEYBOARD)
+        return
+
+    status_message = await message.answer('Мы начали создавать инфографику! Подождите одну минуту')
+
+    # Download the photo once, the same bytes go to the preview and to the renderer
+    try:
+        with render_stage_seconds.time(stage='download'):
+            product_image = await image_fetcher.fetch(product_image)
+    except ImageTooLarge:
+        await message.answer('Изображение товара слишком большое, мы не можем его обработать',
+                             reply_markup=CHOOSE_KEYBOARD)
+        return
+    except Exception:
+        logger.error(f'Failed to download the image of {data["sku"]}: {traceback.format_exc()}')
+        await message.answer('Не получилось скачать изображение товара, попробуйте еще раз',
+                             reply_markup=CHOOSE_KEYBOARD)
+        return
 
-    await message.answer('Мы начали создавать инфографику! Подождите одну минуту')
+    image = BufferedInputFile(product_image, filename='product.jpg')
     await message.answer_photo(image, caption=f'Найденный товар')
 
-    infographic_path = get_infographic_for_product(product_image, product_name, product_description)
-    # infographic_path = 'tmp.jpg'
-    image = FSInputFile(infographic_path, filename='sas.png')
+    async def report_progress(stage):
+        await status_message.edit_text(RENDER_STAGE_MESSAGES[stage])
+
+    try:
+        infographic = await render_queue.submit(get_infographic_for_product,
+                                                product_image, product_name, product_description,
+                                                output_format=INFOGRAPHIC_FORMAT, quality=INFOGRAPHIC_QUALITY,
+                                                progress=report_progress)
+    except RenderQueueFull:
+        await message.answer(RENDER_QUEUE_FULL_MESSAGE, reply_markup=CHOOSE_KEYBOARD)
+        return
+    except Exception:
+        logger.error(f'Failed to create infographic for {data["sku"]}: {traceback.format_exc()}')
+        await message.answer('Не получилось создать инфографику, попробуйте еще раз', reply_markup=CHOOSE_KEYBOARD)
+        return
+
+    image = BufferedInputFile(infographic, filename=f'infographic.{OUTPUT_FORMATS[INFOGRAPHIC_FORMAT][1]}')
     await message.answer_photo(image, caption=f'Ваша инфографика готова!', reply_markup=AFTER_CHECKOUT_KEYBOARD)
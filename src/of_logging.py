@@ -1,31 +1,164 @@
+import atexit
+import json
 import logging
-import logging.config
-from aiogram import types, BaseMiddleware
-from aiogram.fsm.context import FSMContext
-
-from aiogram.types import TelegramObject, Message, Update
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from aiogram.types import Update
 from typing import Callable, Dict, Any, Awaitable
+
+CHAT_LOGGER = 'chat_logger'
+TEXT_FORMATS = {
+    CHAT_LOGGER: logging.Formatter('%(asctime)s - %(message)s'),
+    None: logging.Formatter('%(asctime)s: %(message)s', datefmt='%d/%m/%Y %H:%M:%S'),
+}
+
+# Records from every logger go through this queue; the event loop only ever enqueues
+log_queue = queue.SimpleQueue()
+
 # Create a custom logger
-logger = logging.getLogger('chat_logger')
+logger = logging.getLogger(CHAT_LOGGER)
 logger.propagate = False
 logger.setLevel(logging.INFO)
 
-# Remove any default handlers
+# Remove any default handlers, setup_logging adds the queue one
 for handler in logger.handlers[:]:
     logger.removeHandler(handler)
 
-# Create handlers
-file_handler = logging.FileHandler('db/logs/chat_logs.log')
-stdout_handler = logging.StreamHandler()
+chat_log_sample_rate = 1.0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Fields passed as `extra={'fields': {...}}` become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BatchWriter:
+    """Formats a batch of records and writes them to a stream with one write and one flush."""
+
+    def __init__(self, stream, formatters, logger_names=None, exclude_logger_names=()):
+        self.stream = stream
+        self.formatters = formatters
+        self.logger_names = logger_names
+        self.exclude_logger_names = exclude_logger_names
+
+    def accepts(self, record):
+        if self.logger_names is not None:
+            return record.name in self.logger_names
+        return record.name not in self.exclude_logger_names
+
+    def format(self, record):
+        formatter = self.formatters.get(record.name) or self.formatters[None]
+        return formatter.format(record)
+
+    def write_batch(self, records):
+        lines = [self.format(record) for record in records if self.accepts(record)]
+        if not lines:
+            return
+        try:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except Exception:
+            print(f'Failed to write {len(lines)} log records', file=sys.stderr)
 
-# Create formatters and add them to handlers
-formatter = logging.Formatter('%(asctime)s - %(message)s')
-file_handler.setFormatter(formatter)
-stdout_handler.setFormatter(formatter)
+    def close(self):
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
 
-# Add handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(stdout_handler)
+
+class BatchLogListener:
+    """Drains `log_queue` on a background thread and hands everything queued so far to the writers at once.
+
+    A lone record is written right away; under a burst the records that piled up while the
+    previous batch was being written go out together, up to `max_batch` per write.
+    """
+    _STOP = object()
+
+    def __init__(self, log_queue, writers, max_batch=512):
+        self.queue = log_queue
+        self.writers = writers
+        self.max_batch = max_batch
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            record = self.queue.get()
+            while True:
+                if record is self._STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for writer in self.writers:
+                writer.write_batch(batch)
+
+    def stop(self):
+        """Write out what is queued and stop. Records logged afterwards stay in the queue."""
+        if self._thread is None:
+            return
+        self.queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+        for writer in self.writers:
+            writer.close()
+
+
+def setup_logging(logs_path, log_format='text', sample_rate=1.0, level=logging.INFO):
+    """Send the root logger and the chat log through `log_queue` to tg_bot.log, chat_logs.log and stderr.
+
+    `log_format` is `text` or `json` (JSON lines). `sample_rate` is the share of incoming
+    messages written to the chat log. Returns the started listener; stop it on shutdown.
+    """
+    global chat_log_sample_rate
+    chat_log_sample_rate = sample_rate
+
+    if log_format == 'json':
+        formatters = {None: JsonFormatter()}
+    elif log_format == 'text':
+        formatters = TEXT_FORMATS
+    else:
+        raise ValueError(f'Unknown log_format {log_format!r}, expected text or json')
+
+    root = logging.getLogger()
+    for queued_logger in (root, logger):
+        for handler in queued_logger.handlers[:]:
+            queued_logger.removeHandler(handler)
+        queued_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = BatchLogListener(log_queue, [
+        BatchWriter(open(logs_path + 'tg_bot.log', 'a', encoding='utf-8'), formatters,
+                    exclude_logger_names=(CHAT_LOGGER,)),
+        BatchWriter(open(logs_path + 'chat_logs.log', 'a', encoding='utf-8'), formatters,
+                    logger_names=(CHAT_LOGGER,)),
+        BatchWriter(sys.stderr, formatters),
+    ])
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 
 async def logging_middleware(
@@ -34,7 +167,7 @@ async def logging_middleware(
         data: Dict[str, Any]
     ) -> Any:
 
-    if isinstance(event, Update) and event.message:
+    if isinstance(event, Update) and event.message and random.random() < chat_log_sample_rate:
         message = event.message
         user_id = message.from_user.id
         username = "@" + message.from_user.username if message.from_user.username else "No Username"
@@ -42,15 +175,19 @@ async def logging_middleware(
 
         # Initialize file_id as empty, will remain empty if no files are in the message
         file_id = ''
-        
+        file_kind = None
+
         if message.document:
-            file_id = f", File ID (Document): {message.document.file_id}"
+            file_kind, file_id = 'document', message.document.file_id
         elif message.photo:
-            file_id = f", File ID (Photo): {message.photo[-1].file_id}"  # Get largest resolution photo
+            file_kind, file_id = 'photo', message.photo[-1].file_id  # Get largest resolution photo
         elif message.video:
-            file_id = f", File ID (Video): {message.video.file_id}"
+            file_kind, file_id = 'video', message.video.file_id
         # You can add more conditions for other media types
 
-        logger.info(f"User: {user_id}, Username: {username}, Text: {text}{file_id}")
+        file_info = f", File ID ({file_kind.capitalize()}): {file_id}" if file_kind else ''
+        logger.info(f"User: {user_id}, Username: {username}, Text: {text}{file_info}",
+                    extra={'fields': {'user_id': user_id, 'username': username, 'text': text,
+                                      'file_kind': file_kind, 'file_id': file_id or None}})
 
     return await handler(event, data)
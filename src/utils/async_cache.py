@@ -0,0 +1,63 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class AsyncTTLCache:
+    """Results of coroutines kept for `ttl` seconds, at most `max_items` of them, least recently used dropped first.
+
+    Concurrent `get_or_load` calls for a key that is not cached share one in-flight load.
+    Failed loads are not cached.
+    """
+    ttl: float
+    max_items: int
+
+    def __init__(self, ttl, max_items):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._in_flight = {}
+
+    def configure(self, ttl, max_items):
+        self.ttl = ttl
+        self.max_items = max_items
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        """Return the cached value for `key`, or await `loader()` (shared with concurrent callers) and cache it."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(loader())
+            task.add_done_callback(lambda done: self._on_loaded(key, done))
+        # One caller going away must not cancel the load the others are waiting for
+        return await asyncio.shield(task)
+
+    def _on_loaded(self, key, task):
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.set(key, task.result())
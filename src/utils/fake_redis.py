@@ -0,0 +1,141 @@
+import time
+
+
+def _score(value):
+    return float(value)
+
+
+class FakeRedis:
+    """In-process stand-in for `redis.asyncio.Redis(decode_responses=True)`.
+
+    Implements only the commands the bot uses, with the same return values, so the Redis
+    backends can run in tests and locally without a server. State lives in this object only.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+
+    def _alive(self, name):
+        expires_at = self._expires.get(name)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+        return name in self._data
+
+    def _get(self, name, default_factory):
+        if not self._alive(name):
+            self._data[name] = default_factory()
+        return self._data[name]
+
+    async def get(self, name):
+        return self._data[name] if self._alive(name) else None
+
+    async def set(self, name, value, ex=None, nx=False):
+        if nx and self._alive(name):
+            return None
+        self._data[name] = str(value)
+        self._expires.pop(name, None)
+        if ex is not None:
+            await self.expire(name, ex)
+        return True
+
+    async def delete(self, *names):
+        deleted = 0
+        for name in names:
+            if self._alive(name):
+                del self._data[name]
+                self._expires.pop(name, None)
+                deleted += 1
+        return deleted
+
+    async def expire(self, name, time_seconds):
+        if not self._alive(name):
+            return False
+        seconds = time_seconds.total_seconds() if hasattr(time_seconds, 'total_seconds') else time_seconds
+        self._expires[name] = time.monotonic() + seconds
+        return True
+
+    async def hgetall(self, name):
+        return dict(self._data[name]) if self._alive(name) else {}
+
+    async def hset(self, name, key=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        fields = self._get(name, dict)
+        added = sum(1 for field in items if field not in fields)
+        fields.update((field, str(field_value)) for field, field_value in items.items())
+        return added
+
+    async def hsetnx(self, name, key, value):
+        fields = self._get(name, dict)
+        if key in fields:
+            return False
+        fields[key] = str(value)
+        return True
+
+    async def zadd(self, name, mapping):
+        members = self._get(name, dict)
+        added = sum(1 for member in mapping if member not in members)
+        members.update((member, float(score)) for member, score in mapping.items())
+        return added
+
+    async def zrem(self, name, *values):
+        members = self._get(name, dict)
+        return sum(1 for value in values if members.pop(value, None) is not None)
+
+    async def zcard(self, name):
+        return len(self._data[name]) if self._alive(name) else 0
+
+    async def zcount(self, name, min, max):
+        if not self._alive(name):
+            return 0
+        low, high = _score(min), _score(max)
+        return sum(1 for score in self._data[name].values() if low <= score <= high)
+
+    async def zremrangebyscore(self, name, min, max):
+        if not self._alive(name):
+            return 0
+        low, high = _score(min), _score(max)
+        members = self._data[name]
+        removed = [member for member, score in members.items() if low <= score <= high]
+        for member in removed:
+            del members[member]
+        return len(removed)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def close(self, close_connection_pool=None):
+        pass
+
+    async def aclose(self, close_connection_pool=None):
+        pass
+
+
+class FakePipeline:
+    """Queues commands and runs them back to back on `execute()`. Nothing else runs on the
+    event loop in between, which is as atomic as MULTI/EXEC is for a single process."""
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    def __getattr__(self, command):
+        method = getattr(self._redis, command)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self._commands = self._commands, []
+        return [await method(*args, **kwargs) for method, args, kwargs in commands]
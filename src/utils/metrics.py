@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram.types import Update
+from aiohttp import web
+
+logger = logging.getLogger('tg_main')
+
+# Seconds; the render stages range from milliseconds (placing the photo) to minutes (Fusionbrain queue)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5,
+                   10, 15, 20, 30, 45, 60, 90, 120, 180, 300, math.inf)
+
+
+class Histogram:
+    """Cumulative latency histogram per label set, safe to observe from any thread."""
+    name: str
+    buckets: tuple
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        label_values = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block took, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """{label values: (per-bucket counts, sum)}, the counts not cumulative."""
+        with self._lock:
+            return {label_values: (list(counts), total) for label_values, (counts, total) in self._series.items()}
+
+    def _labels(self, label_values, **extra):
+        pairs = list(zip(self.labelnames, label_values)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(float(bound))
+                lines.append(f'{self.name}_bucket{self._labels(label_values, le=le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(label_values)} {total}')
+            lines.append(f'{self.name}_count{self._labels(label_values)} {cumulative}')
+        return lines
+
+
+def quantile(buckets, counts, q):
+    """Estimate the `q` quantile from per-bucket counts, interpolating linearly inside the bucket."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            lower = buckets[i - 1] if i else 0.0
+            upper = buckets[i] if buckets[i] != math.inf else lower
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-2]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = []
+        self._last_logged = {}
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self.histograms.append(histogram)
+        return histogram
+
+    def render(self):
+        return '\n'.join(line for histogram in self.histograms for line in histogram.render()) + '\n'
+
+    def summary_lines(self):
+        """One line per label set with the count, p50 and p95 observed since the previous call."""
+        lines = []
+        for histogram in self.histograms:
+            for label_values, (counts, total) in sorted(histogram.snapshot().items()):
+                key = (histogram.name, label_values)
+                previous_counts, previous_total = self._last_logged.get(key, ([0] * len(counts), 0.0))
+                self._last_logged[key] = (counts, total)
+                delta = [count - previous for count, previous in zip(counts, previous_counts)]
+                if not sum(delta):
+                    continue
+                labels = ','.join(f'{name}={value}' for name, value in zip(histogram.labelnames, label_values))
+                lines.append(f'{histogram.name}{{{labels}}} n={sum(delta)} '
+                             f'mean={(total - previous_total) / sum(delta):.3f}s '
+                             f'p50={quantile(histogram.buckets, delta, 0.5):.3f}s '
+                             f'p95={quantile(histogram.buckets, delta, 0.95):.3f}s')
+        return lines
+
+    async def log_summaries(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            for line in self.summary_lines():
+                logger.info(f'Latency {line}')
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def serve(self, host, port):
+        """Start serving /metrics in Prometheus text format. Returns the runner to clean up on shutdown.
+
+        If the port cannot be bound the error is logged and None is returned, the bot runs without the endpoint.
+        """
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            logger.error(f'Cannot serve metrics on {host}:{port}: {e}')
+            await runner.cleanup()
+            return None
+        logger.info(f'Serving metrics on {host}:{port}/metrics')
+        return runner
+
+
+metrics = MetricsRegistry()
+
+render_stage_seconds = metrics.histogram(
+    'render_stage_seconds', 'Time spent in each stage of rendering an infographic', ['stage'])
+render_seconds = metrics.histogram(
+    'render_seconds', 'Time to produce an infographic, by whether it came from the result cache', ['cache'])
+update_handling_seconds = metrics.histogram(
+    'update_handling_seconds', 'Time to handle a Telegram update, by update type', ['event_type'])
+
+
+async def metrics_middleware(
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        event_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        update_handling_seconds.observe(time.perf_counter() - start, event_type=event_type)
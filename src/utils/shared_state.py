@@ -0,0 +1,75 @@
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+
+from src.utils.fake_redis import FakeRedis
+from src.utils.usage_limit import UsageLimiter, RedisUsageLimiter
+from src.utils.user_store import UserStore, RedisUserStore
+
+GLOBAL_CONFIG_PATH = 'configs/global.ini'
+STATE_BACKENDS = ('sqlite', 'redis', 'fake')
+
+
+class SharedState:
+    """FSM storage, bot users and usage counters, all on the backend chosen in global.ini.
+
+    `sqlite` keeps FSM data in process memory and users and usage in local SQLite files, which
+    ties the bot to one process. `redis` keeps all three in Redis, so any number of bot
+    processes on any number of hosts can serve the same users. `fake` runs the Redis code
+    paths against an in-process FakeRedis, for tests and local runs without a server.
+    Nothing is set up until `configure()`, so importing the handlers opens no database.
+    """
+    backend: str
+
+    def __init__(self):
+        self.backend = None
+        self.user_db_path = None
+        self.fsm_ttl = None
+        self.redis = None
+        self.user_store = None
+        self.usage_limiter = None
+
+    def configure(self, backend, redis_url, user_db_path, usage_db_path_base, config_path, fsm_ttl=None):
+        """Switch to another backend. Handlers look the stores up here on every call, so they follow."""
+        if backend not in STATE_BACKENDS:
+            raise ValueError(f'Unknown state_backend {backend!r}, expected one of {", ".join(STATE_BACKENDS)}')
+        self.backend = backend
+        self.user_db_path = user_db_path
+        self.fsm_ttl = fsm_ttl
+
+        if backend == 'redis':
+            self.redis = Redis.from_url(redis_url, decode_responses=True)
+        elif backend == 'fake':
+            self.redis = FakeRedis()
+        else:
+            self.redis = None
+
+        if self.redis is None:
+            self.user_store = UserStore(user_db_path)
+            self.usage_limiter = UsageLimiter(config_path=config_path, db_path_base=usage_db_path_base)
+        else:
+            self.user_store = RedisUserStore(self.redis)
+            self.usage_limiter = RedisUsageLimiter(self.redis, config_path=config_path)
+
+    def create_fsm_storage(self):
+        if self.redis is None:
+            return MemoryStorage()
+        return RedisStorage(self.redis, state_ttl=self.fsm_ttl, data_ttl=self.fsm_ttl)
+
+    async def migrate_users(self, bot_db_path):
+        """Bring users over from tg_bot.json and, on Redis, from an earlier SQLite deployment."""
+        await self.user_store.migrate_from_json(bot_db_path)
+        if self.redis is not None:
+            await self.user_store.migrate_from_sqlite(self.user_db_path)
+
+    def start(self):
+        self.usage_limiter.start()
+
+    async def close(self):
+        await self.usage_limiter.close()
+        self.user_store.close()
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+shared_state = SharedState()
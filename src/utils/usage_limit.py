@@ -1,69 +1,230 @@
-import configobj
+import asyncio
+import logging
 import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
 
-from src.utils.json_utils import load_json, save_json, create_json_if_not_exist
+import configobj
 from dateutil.parser import parse
-from datetime import datetime, timedelta
-import pytz
+
+from src.utils.json_utils import load_json
 
 USAGE_DB = 'usage_db.json'
+USAGE_SQLITE_DB = 'usage.sqlite3'
+WINDOW_SECONDS = 24 * 60 * 60
+
+logger = logging.getLogger('tg_main')
+
+
+def read_usage_config(config_path):
+    usage_config = configobj.ConfigObj(config_path)
+    admins = usage_config['admins']
+    if isinstance(admins, str):
+        admins = [admins] if admins else []
+    return int(usage_config['daily_usage_limit']), set(admins)
 
 
 class UsageLimiter:
+    """Sliding 24h usage limit per user.
+
+    Usage is kept in memory as per-user deques of epoch seconds, pruned on access, so checks
+    never touch disk. Changed users are written to SQLite by a background task every
+    `flush_interval` seconds and on `close()`. The database is opened, and usage_db.json
+    migrated, by `start()` or the first check, not on construction.
+    """
     config_path: str
     usage_db_path: str
-    
-    def __init__(self, config_path, db_path_base):
+
+    def __init__(self, config_path, db_path_base, flush_interval=5):
         self.config_path = config_path
-        self.usage_db_path = os.path.join(db_path_base, USAGE_DB)
-    
+        self.usage_db_path = os.path.join(db_path_base, USAGE_SQLITE_DB)
+        self.legacy_usage_db_path = os.path.join(db_path_base, USAGE_DB)
+        self.flush_interval = flush_interval
+
+        self.daily_usage_limit, self.admins = read_usage_config(config_path)
+
+        self._usage = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._conn = None
+        self._flush_task = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.usage_db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.usage_db_path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS usage (user_id TEXT NOT NULL, used_at INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS usage_user_id ON usage (user_id)')
+            self._conn = conn
+        return self._conn
+
+    def _load(self):
+        conn = self._connection()
+        since = int(time.time()) - WINDOW_SECONDS
+        rows = conn.execute('SELECT user_id, used_at FROM usage WHERE used_at > ? ORDER BY used_at',
+                            (since,)).fetchall()
+        if not rows and os.path.exists(self.legacy_usage_db_path):
+            rows = self._read_legacy_usage(since)
+            self._dirty.update(user_id for user_id, _ in rows)
+
+        for user_id, used_at in rows:
+            self._usage.setdefault(user_id, deque()).append(used_at)
+        self._flush()
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self._load()
+                self._loaded = True
+
+    def _read_legacy_usage(self, since):
+        # usage_db.json kept every timestamp forever as a datetime string, only the last day matters
+        rows = []
+        daily_usage = load_json(self.legacy_usage_db_path).get('daily_usage', {})
+        for user_id, timestamps in daily_usage.items():
+            for timestamp in timestamps:
+                used_at = int(parse(timestamp).timestamp())
+                if used_at > since:
+                    rows.append((user_id, used_at))
+        rows.sort(key=lambda row: row[1])
+        logger.info(f'Loaded {len(rows)} recent usages from {self.legacy_usage_db_path}')
+        return rows
+
+    def _recent_usage(self, user_id, now):
+        usage = self._usage.get(user_id)
+        if usage is None:
+            return None
+        while usage and usage[0] <= now - WINDOW_SECONDS:
+            usage.popleft()
+            self._dirty.add(user_id)
+        return usage
+
     def get_limit(self, user_id):
-        user_id = str(user_id)
-        usage_config = configobj.ConfigObj(self.config_path)
-        daily_usage_limit = int(usage_config['daily_usage_limit'])
-        return daily_usage_limit
+        return self.daily_usage_limit
 
-    def can_use(self, user_id):
+    def _can_use(self, user_id):
         user_id = str(user_id)
-        daily_usage_limit = self.get_limit(user_id)
-
-        admins = configobj.ConfigObj(self.config_path)['admins']
-        if user_id in admins:
+        if user_id in self.admins:
             return True
+        self._ensure_loaded()
+
+        with self._lock:
+            usage = self._recent_usage(user_id, int(time.time()))
+            return usage is None or len(usage) < self.daily_usage_limit
 
-        create_json_if_not_exist(
-            self.usage_db_path, 
-            {
-                'daily_usage': {}
-            }
-        )
-        usage_db = load_json(self.usage_db_path)
-        
-        now = datetime.now(pytz.timezone('Europe/Moscow'))
-
-        if user_id in usage_db['daily_usage']:
-            daily_usage = usage_db['daily_usage'][user_id]
-
-            daily_usage_filtered = [t for t in daily_usage if parse(t) > now - timedelta(days=1)]
-            if len(daily_usage_filtered) >= daily_usage_limit:
+    def _use(self, user_id):
+        user_id = str(user_id)
+        self._ensure_loaded()
+        now = int(time.time())
+
+        with self._lock:
+            usage = self._recent_usage(user_id, now)
+            if user_id not in self.admins and usage is not None and len(usage) >= self.daily_usage_limit:
                 return False
+            self._usage.setdefault(user_id, deque()).append(now)
+            self._dirty.add(user_id)
         return True
 
+    # Async like RedisUsageLimiter so callers work with either; these never wait on I/O
+    async def can_use(self, user_id):
+        return self._can_use(user_id)
+
+    async def use(self, user_id):
+        return self._use(user_id)
+
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            snapshot = [(user_id, list(self._usage.get(user_id, ()))) for user_id in dirty]
+        if not snapshot:
+            return
+
+        with self._flush_lock:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            try:
+                for user_id, usage in snapshot:
+                    conn.execute('DELETE FROM usage WHERE user_id = ?', (user_id,))
+                    conn.executemany('INSERT INTO usage (user_id, used_at) VALUES (?, ?)',
+                                     [(user_id, used_at) for used_at in usage])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                with self._lock:
+                    self._dirty.update(user_id for user_id, _ in snapshot)
+                raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self._flush)
+            except Exception:
+                logger.exception('Failed to flush usage')
+
+    def start(self):
+        self._ensure_loaded()
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await asyncio.to_thread(self._flush)
+
+
+class RedisUsageLimiter:
+    """The same sliding 24h limit kept in Redis, one sorted set of timestamps per user,
+    so every bot process sees the same counters."""
+    config_path: str
+
+    def __init__(self, redis, config_path, prefix='usage:'):
+        self.redis = redis
+        self.config_path = config_path
+        self.prefix = prefix
+        self.daily_usage_limit, self.admins = read_usage_config(config_path)
+
+    def get_limit(self, user_id):
+        return self.daily_usage_limit
 
-    def use(self, user_id):
+    async def can_use(self, user_id):
         user_id = str(user_id)
-        
-        if not self.can_use(user_id):
-            return False
+        if user_id in self.admins:
+            return True
+        used = await self.redis.zcount(self.prefix + user_id, time.time() - WINDOW_SECONDS, '+inf')
+        return used < self.daily_usage_limit
 
-        usage_db = load_json(self.usage_db_path)
-        
-        now = datetime.now(pytz.timezone('Europe/Moscow'))
+    async def use(self, user_id):
+        user_id = str(user_id)
+        key = self.prefix + user_id
+        now = time.time()
+        member = f'{now}:{uuid.uuid4().hex}'
 
-        if user_id not in usage_db['daily_usage']:
-            usage_db['daily_usage'][user_id] = []
+        # Record first and check after, so two processes cannot both take the last slot
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now - WINDOW_SECONDS)
+            pipe.zadd(key, {member: now})
+            pipe.zcard(key)
+            pipe.expire(key, WINDOW_SECONDS)
+            _, _, used, _ = await pipe.execute()
 
-        usage_db['daily_usage'][user_id].append(str(now))
+        if user_id in self.admins or used <= self.daily_usage_limit:
+            return True
+        await self.redis.zrem(key, member)
+        return False
 
-        save_json(self.usage_db_path, usage_db)
-        return True
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+
+from src.utils.json_utils import load_json
+
+logger = logging.getLogger('tg_main')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    nickname TEXT,
+    num_credits INTEGER NOT NULL DEFAULT 0,
+    ozon_token TEXT NOT NULL DEFAULT '',
+    email TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS users_nickname ON users (nickname);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY
+);
+'''
+
+USER_FIELDS = ('user_id', 'nickname', 'num_credits', 'ozon_token', 'email')
+
+
+def read_json_users(json_path):
+    """Users from the old tg_bot.json layout, as dicts with USER_FIELDS."""
+    if not os.path.exists(json_path):
+        return []
+    bot_db = load_json(json_path)
+    nicknames = bot_db.get('ids_to_users_nicknames_map', {})
+    return [{
+        'user_id': user_id,
+        'nickname': nicknames.get(user_id),
+        'num_credits': info.get('num_credits', 0),
+        'ozon_token': info.get('ozon_token', ''),
+        'email': info.get('email', ''),
+    } for user_id, info in bot_db.get('user_info', {}).items()]
+
+
+class UserStore:
+    """Bot users in SQLite (WAL mode). The async methods run the queries off the event loop."""
+    db_path: str
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            cursor = self._connection().execute(query, params)
+            return cursor.fetchall(), cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _get_user(self, user_id):
+        rows, _ = self._execute(f'SELECT {", ".join(USER_FIELDS)} FROM users WHERE user_id = ?', (str(user_id),))
+        return dict(zip(USER_FIELDS, rows[0])) if rows else None
+
+    def _get_user_id_by_nickname(self, nickname):
+        rows, _ = self._execute('SELECT user_id FROM users WHERE nickname = ?', (nickname,))
+        return rows[0][0] if rows else None
+
+    def _add_user(self, user_id, nickname, num_credits):
+        """Add the user if they are new. Returns True if they were added."""
+        _, added = self._execute('INSERT OR IGNORE INTO users (user_id, nickname, num_credits) VALUES (?, ?, ?)',
+                                 (str(user_id), nickname, num_credits))
+        return added > 0
+
+    def _set_ozon_token(self, user_id, ozon_token):
+        self._execute('INSERT INTO users (user_id, ozon_token) VALUES (?, ?) '
+                      'ON CONFLICT (user_id) DO UPDATE SET ozon_token = excluded.ozon_token',
+                      (str(user_id), ozon_token))
+
+    def _get_all_users(self):
+        rows, _ = self._execute(f'SELECT {", ".join(USER_FIELDS)} FROM users')
+        return [dict(zip(USER_FIELDS, row)) for row in rows]
+
+    async def get_user(self, user_id):
+        return await asyncio.to_thread(self._get_user, user_id)
+
+    async def get_user_id_by_nickname(self, nickname):
+        return await asyncio.to_thread(self._get_user_id_by_nickname, nickname)
+
+    async def add_user(self, user_id, nickname, num_credits):
+        return await asyncio.to_thread(self._add_user, user_id, nickname, num_credits)
+
+    async def set_ozon_token(self, user_id, ozon_token):
+        await asyncio.to_thread(self._set_ozon_token, user_id, ozon_token)
+
+    async def get_all_users(self):
+        return await asyncio.to_thread(self._get_all_users)
+
+    def _migrate_from_json(self, json_path):
+        """Copy users from the old tg_bot.json layout once. The JSON file is left in place."""
+        rows, _ = self._execute('SELECT 1 FROM migrations WHERE name = ?', ('tg_bot_json',))
+        if rows:
+            return 0
+
+        users = [tuple(user[field] for field in USER_FIELDS) for user in read_json_users(json_path)]
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('INSERT OR IGNORE INTO users (user_id, nickname, num_credits, ozon_token, email) '
+                                 'VALUES (?, ?, ?, ?, ?)', users)
+                conn.execute('INSERT INTO migrations (name) VALUES (?)', ('tg_bot_json',))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        logger.info(f'Migrated {len(users)} users from {json_path} to {self.db_path}')
+        return len(users)
+
+    async def migrate_from_json(self, json_path):
+        return await asyncio.to_thread(self._migrate_from_json, json_path)
+
+
+class RedisUserStore:
+    """Bot users in Redis, one hash per user plus a nickname -> user_id key, shared by all bot processes."""
+
+    def __init__(self, redis, prefix=''):
+        self.redis = redis
+        self.prefix = prefix
+
+    def _user_key(self, user_id):
+        return f'{self.prefix}user:{user_id}'
+
+    def _nickname_key(self, nickname):
+        return f'{self.prefix}user_nickname:{nickname}'
+
+    def close(self):
+        # The Redis connection belongs to SharedState
+        pass
+
+    async def get_user(self, user_id):
+        fields = await self.redis.hgetall(self._user_key(user_id))
+        if not fields:
+            return None
+        return {
+            'user_id': fields.get('user_id', str(user_id)),
+            'nickname': fields.get('nickname'),
+            'num_credits': int(fields.get('num_credits', 0)),
+            'ozon_token': fields.get('ozon_token', ''),
+            'email': fields.get('email', ''),
+        }
+
+    async def get_user_id_by_nickname(self, nickname):
+        return await self.redis.get(self._nickname_key(nickname))
+
+    async def add_user(self, user_id, nickname, num_credits):
+        """Add the user if they are new. Returns True if they were added."""
+        user_id = str(user_id)
+        if not await self.redis.hsetnx(self._user_key(user_id), 'user_id', user_id):
+            return False
+        await self._write_user({'user_id': user_id, 'nickname': nickname, 'num_credits': num_credits,
+                                'ozon_token': '', 'email': ''})
+        return True
+
+    async def set_ozon_token(self, user_id, ozon_token):
+        await self.redis.hset(self._user_key(user_id), mapping={'user_id': str(user_id), 'ozon_token': ozon_token})
+
+    async def _write_user(self, user):
+        mapping = {field: user[field] for field in USER_FIELDS if user[field] is not None}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._user_key(user['user_id']), mapping=mapping)
+            if user['nickname']:
+                pipe.set(self._nickname_key(user['nickname']), user['user_id'])
+            await pipe.execute()
+
+    async def _import_once(self, name, users):
+        # Users that already exist are skipped, so an import interrupted halfway can simply run again
+        migration_key = f'{self.prefix}migrations:{name}'
+        if await self.redis.get(migration_key):
+            return 0
+        imported = 0
+        for user in users:
+            if await self.redis.hsetnx(self._user_key(user['user_id']), 'user_id', user['user_id']):
+                await self._write_user(user)
+                imported += 1
+        await self.redis.set(migration_key, 1)
+        return imported
+
+    async def migrate_from_json(self, json_path):
+        """Copy users from the old tg_bot.json layout once. The JSON file is left in place."""
+        users = await asyncio.to_thread(read_json_users, json_path)
+        imported = await self._import_once('tg_bot_json', users)
+        logger.info(f'Migrated {imported} users from {json_path} to Redis')
+        return imported
+
+    async def migrate_from_sqlite(self, db_path):
+        """Copy users from a UserStore database once, for deployments moving from sqlite to redis."""
+        if not os.path.exists(db_path):
+            return 0
+        sqlite_store = UserStore(db_path)
+        try:
+            users = await sqlite_store.get_all_users()
+        finally:
+            sqlite_store.close()
+        imported = await self._import_once('users_sqlite', users)
+        logger.info(f'Migrated {imported} users from {db_path} to Redis')
+        return imported
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import secrets
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+logger = logging.getLogger('tg_main')
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Receives updates over HTTP instead of long polling.
+
+    Every update is acknowledged as soon as its body is read and handled in its own task, so a
+    slow handler (a render job) never holds up Telegram's delivery of the next update. On
+    shutdown the server stops accepting requests, then waits up to `shutdown_timeout` seconds for
+    the updates it already took to be handled.
+    """
+    path: str
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, path, secret_token=None, shutdown_timeout=60):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.shutdown_timeout = shutdown_timeout
+        self._tasks = set()
+        self._accepting = True
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request):
+        if self.secret_token and not secrets.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''),
+                                                            self.secret_token):
+            return web.Response(status=401, text='Unauthorized')
+        if not self._accepting:
+            # Telegram retries the update later, by then another instance or the restarted one takes it
+            return web.Response(status=503, text='Shutting down')
+
+        try:
+            update = await request.json(loads=self.bot.session.json_loads)
+        except ValueError:
+            return web.Response(status=400, text='Bad update')
+
+        task = asyncio.create_task(self._feed_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({})
+
+    async def _feed_update(self, update):
+        try:
+            result = await self.dispatcher.feed_raw_update(self.bot, update)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, result)
+        except Exception:
+            logger.exception(f'Failed to handle update {update.get("update_id")}')
+
+    async def drain(self, timeout=None):
+        """Stop taking updates and wait for the ones in flight. Returns False if `timeout` ran out first."""
+        self._accepting = False
+        if not self._tasks:
+            return True
+        logger.info(f'Waiting for {len(self._tasks)} updates in flight')
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning(f'{len(pending)} updates still running after {timeout}s')
+            return False
+        return True
+
+    async def serve(self, host, port):
+        """Serve until SIGINT or SIGTERM, then drain the updates in flight."""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        logger.info(f'Serving webhook on {host}:{port}{self.path}')
+        try:
+            await stop.wait()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            logger.info('Stopping webhook server')
+            await self.drain(self.shutdown_timeout)
+            await runner.cleanup()
@@ -0,0 +1,72 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message
+
+from benchmarks.fake_telegram import FakeTelegramSession
+from src.handlers import covers
+
+USER = {'id': 42, 'is_bot': False, 'first_name': 'Seller'}
+
+
+class ClosingSession(FakeTelegramSession):
+    """Records sent methods, and fails every request made after close() as a closed connector would."""
+
+    def __init__(self, latency):
+        super().__init__(latency=latency)
+        self.closed = False
+        self.sent = []
+
+    async def close(self):
+        self.closed = True
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.closed:
+            raise RuntimeError('Session is closed')
+        result = await super().make_request(bot, method, timeout)
+        if self.closed:
+            raise RuntimeError('Session was closed during the request')
+        self.sent.append((method.__api_method__, getattr(method, 'caption', None)))
+        return result
+
+
+class ShutdownTest(unittest.IsolatedAsyncioTestCase):
+    async def test_infographic_is_sent_before_session_close(self):
+        session = ClosingSession(latency=0.05)
+        bot = Bot(token='1:test', session=session)
+        message = Message.model_validate({
+            'message_id': 1, 'date': int(time.time()), 'text': 'Создать инфографику',
+            'chat': {'id': USER['id'], 'type': 'private'}, 'from': USER,
+        }).as_(bot)
+        state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=USER['id'], user_id=USER['id']))
+        await state.set_data({'sku': 'sku-1', 'name': 'Товар', 'description': 'Описание',
+                              'images': ['https://example.com/photo.jpg']})
+
+        job_started = asyncio.Event()
+
+        async def render(*args, run_blocking, progress, **kwargs):
+            job_started.set()
+            await asyncio.sleep(0.05)
+            return b'infographic'
+
+        with mock.patch.object(covers, 'get_infographic_for_product', render), \
+                mock.patch.object(covers.image_fetcher, 'fetch', mock.AsyncMock(return_value=b'photo')):
+            handler = asyncio.ensure_future(covers.create_infographics(message, state))
+            await job_started.wait()
+
+            # What main() does on shutdown
+            self.assertTrue(await covers.render_queue.drain(5))
+            await bot.session.close()
+            await handler
+
+        self.assertIn(('sendPhoto', 'Ваша инфографика готова!'), session.sent)
+
+
+if __name__ == '__main__':
+    unittest.main()